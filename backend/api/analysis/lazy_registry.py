@@ -0,0 +1,152 @@
+from collections import OrderedDict
+from collections.abc import Mapping
+import threading
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+def disk_size(path):
+    # Size of a model file or SavedModel directory, used as an estimate of its loaded size
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(root, file)) for root, _, files in os.walk(path) for file in files)
+
+class LazyModelRegistry(Mapping):
+    """
+    Model wrappers that are loaded on first use.
+
+    Every model names a backend, the wrapper that loads a model file. Models that name the
+    same backend share a single loaded instance of it. When the estimated size of the loaded
+    backends exceeds memory_budget bytes, the least recently used backends are evicted.
+    A memory_budget of 0 never evicts. Functions in eviction_listeners are called with the
+    name of every evicted backend, so that holders of its models can drop them.
+    """
+    def __init__(self, backends, models, memory_budget=0):
+        """
+        Parameters:
+        backends: dictionary of backend name to a function returning an unloaded model wrapper with a model_path
+        models: dictionary of model name to a tuple of the backend name and a function wrapping the loaded backend
+        memory_budget: maximum estimated size of the loaded backends in bytes
+        """
+        self.backends = backends
+        self.models = models
+        self.memory_budget = memory_budget
+        self.loaded_backends = OrderedDict() # backend name -> (loaded backend, estimated size), least recently used first
+        self.loaded_models = {}
+        self.eviction_listeners = []
+        self.lock = threading.RLock()
+
+    def __getitem__(self, name):
+        backend_name, wrap = self.models[name]
+        with self.lock:
+            backend = self.load_backend(backend_name)
+            model = self.loaded_models.get(name)
+            if model is None or model[0] is not backend:
+                model = (backend, wrap(backend))
+                self.loaded_models[name] = model
+            return model[1]
+
+    def __iter__(self):
+        return iter(self.models)
+
+    def __len__(self):
+        return len(self.models)
+
+    def load_backend(self, backend_name):
+        if backend_name in self.loaded_backends:
+            self.loaded_backends.move_to_end(backend_name)
+            return self.loaded_backends[backend_name][0]
+
+        backend = self.backends[backend_name]()
+        size = disk_size(backend.model_path)
+        self.evict(self.memory_budget - size)
+        logger.info(f"Loading model backend {backend_name} of estimated size {size / 2**20:.1f} MB...")
+        self.loaded_backends[backend_name] = (backend.load_model(), size)
+        return self.loaded_backends[backend_name][0]
+
+    def evict(self, budget):
+        # Evicts the least recently used backends until the loaded ones fit into budget
+        if not self.memory_budget:
+            return
+        while self.loaded_backends and self.loaded_size() > budget:
+            backend_name, _ = self.loaded_backends.popitem(last=False)
+            self.loaded_models = {name: model for name, model in self.loaded_models.items() if self.models[name][0] != backend_name}
+            for listener in self.eviction_listeners:
+                listener(backend_name)
+            logger.info(f"Evicted model backend {backend_name}")
+
+    def loaded_size(self):
+        return sum(size for _, size in self.loaded_backends.values())
+
+class LoadedModelCache:
+    """
+    Least recently used cache of loaded models, keyed by their content hash.
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.models = OrderedDict()
+        self.lock = threading.RLock()
+
+    def get_or_load(self, key, load):
+        with self.lock:
+            if key in self.models:
+                self.models.move_to_end(key)
+                logger.debug(f"Using cached model {key}")
+                return self.models[key]
+
+            model = load()
+            self.models[key] = model
+            while len(self.models) > self.max_size:
+                evicted_key, _ = self.models.popitem(last=False)
+                logger.info(f"Evicted cached model {evicted_key}")
+            return model
+
+class LazyPipelineRegistry(Mapping):
+    """
+    Pipelines that are created on first use from the models of a LazyModelRegistry.
+
+    Listing the registry does not load anything. Pipelines are dropped together with the
+    backend of their model, so an evicted backend is not kept alive by its pipelines, and
+    they are recreated when the model is loaded again.
+    """
+    def __init__(self, models, pipelines):
+        """
+        Parameters:
+        models: LazyModelRegistry the pipelines take their models from
+        pipelines: dictionary of pipeline name to a tuple of the model name and a function creating the pipeline from the model
+        """
+        self.models = models
+        self.pipelines = pipelines
+        self.created_pipelines = {}
+        self.lock = threading.Lock()
+        models.eviction_listeners.append(self.drop_backend)
+
+    def __getitem__(self, name):
+        model_name, create = self.pipelines[name]
+        model = self.models[model_name]
+        with self.lock:
+            pipeline = self.created_pipelines.get(name)
+            if pipeline is None or pipeline.model is not model:
+                pipeline = create(model)
+                self.created_pipelines[name] = pipeline
+            return pipeline
+
+    def drop_backend(self, backend_name):
+        with self.lock:
+            self.created_pipelines = {name: pipeline for name, pipeline in self.created_pipelines.items()
+                                      if self.models.models[self.pipelines[name][0]][0] != backend_name}
+
+    def __iter__(self):
+        return iter(self.pipelines)
+
+    def __len__(self):
+        return len(self.pipelines)
+
+    def warm_up(self, names):
+        for name in names:
+            if name not in self.pipelines:
+                logger.warning(f"Cannot warm up unknown pipeline {name}")
+                continue
+            logger.info(f"Warming up pipeline {name}...")
+            self[name]
@@ -0,0 +1,46 @@
+"""
+Names and parameters of the registry pipelines.
+
+This module must not import TensorFlow or any other inference dependency. The web process
+lists and validates pipelines from it and enqueues tasks by name, only the Celery worker
+instantiates the pipelines in registers.py.
+"""
+
+PROCESS_IMAGE_TASK = 'api.analysis.tasks.process_image'
+DELETE_EXPIRED_RESULTS_TASK = 'api.analysis.tasks.delete_expired_results'
+
+# Uploaded inputs of a request are stored under a prefix of their own, the task only carries their object names
+INPUTS_PREFIX = 'inputs/'
+
+# Registered custom models are stored under their content hash, the id is the hash followed by the file extension
+CUSTOM_MODELS_PREFIX = 'custom-models/'
+CUSTOM_MODEL_ID_PATTERN = r'^[0-9a-f]{64}(\.keras|\.h5|\.zip)$'
+
+pipeline_manifest = {
+    'custom-resize_with_pad 128x128': {'model': 'custom', 'type': 'resize_with_pad', 'target_dimensions': (128, 128)},
+    'custom-tiling 128x128': {'model': 'custom', 'type': 'tiling', 'patch_size': (128, 128, 3)},
+
+    'sm_unet-resize_with_pad 512x512': {'model': 'sm_unet-fixed', 'type': 'resize_with_pad', 'target_dimensions': (512, 512)},
+    'sm_unet-tiling 512x512': {'model': 'sm_unet-fixed', 'type': 'tiling', 'patch_size': (512, 512, 3)},
+
+    'sm_unet-variable-resize_with_pad 1024x1024': {'model': 'sm_unet-variable', 'type': 'resize_with_pad', 'target_dimensions': (1024, 1024)},
+    'sm_unet-variable-resize_with_pad 512x512': {'model': 'sm_unet-variable', 'type': 'resize_with_pad', 'target_dimensions': (512, 512)},
+    'sm_unet-variable-resize_with_pad 128x128': {'model': 'sm_unet-variable', 'type': 'resize_with_pad', 'target_dimensions': (128, 128)},
+    'sm_unet-variable-dynamic_resize_with_pad': {'model': 'sm_unet-variable', 'type': 'dynamic_resize_with_pad', 'downsampling_factor': 64},
+    'sm_unet-variable-variable': {'model': 'sm_unet-variable', 'type': 'variable_shape', 'downsampling_factor': 64},
+    'sm_unet-variable-tiling 128x128': {'model': 'sm_unet-variable', 'type': 'tiling', 'patch_size': (128, 128, 3)},
+    'sm_unet-variable-tiling 512x512': {'model': 'sm_unet-variable', 'type': 'tiling', 'patch_size': (512, 512, 3)},
+    'sm_unet-variable-tiling 1024x1024': {'model': 'sm_unet-variable', 'type': 'tiling', 'patch_size': (1024, 1024, 3)},
+    'sm_unet-variable-overlap_tiling 256x256': {'model': 'sm_unet-variable', 'type': 'tiling', 'patch_size': (256, 256, 3), 'overlap': 32},
+    'sm_unet-variable-tflite-resize_with_pad 512x512': {'model': 'sm_unet-variable-tflite', 'type': 'resize_with_pad', 'target_dimensions': (512, 512)},
+    'sm_unet-variable-tflite-dynamic_resize_with_pad': {'model': 'sm_unet-variable-tflite', 'type': 'dynamic_resize_with_pad', 'downsampling_factor': 64},
+    'sm_unet-variable-tflite-tiling 512x512': {'model': 'sm_unet-variable-tflite', 'type': 'tiling', 'patch_size': (512, 512, 3)},
+    'sm_unet-variable-overlap_tiling 512x512': {'model': 'sm_unet-variable', 'type': 'tiling', 'patch_size': (512, 512, 3), 'overlap': 64},
+}
+
+# Pipeline types a custom model can be run with, by their display names
+custom_pipeline_types = {
+    "Tiling": 'tiling',
+    "Resizing with padding": 'resize_with_pad',
+    "Dynamic resizing with padding": 'dynamic_resize_with_pad',
+}
@@ -11,4 +11,8 @@ class AbstractModelWrapper(ABC):
 
     @abstractmethod
     def predict(self, input_data):
-        pass
\ No newline at end of file
+        pass
+
+    def predict_batch(self, input_batch):
+        # Predicts a single in-memory batch, wrappers override this to skip the per-call overhead of predict
+        return self.predict(input_batch)
\ No newline at end of file
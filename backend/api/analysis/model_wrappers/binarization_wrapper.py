@@ -1,16 +1,62 @@
 from .abstract_model_wrapper import AbstractModelWrapper
 import tensorflow as tf
+import numpy as np
+from api.analysis.processing.tracing import count_trace
+
+def pack_bits(mask):
+    # Packs a boolean mask of shape (n, height, width, channels) into uint8 bytes of 8 pixels along the width
+    width = tf.shape(mask)[2]
+    padded_width = (width + 7) // 8 * 8
+    bits = tf.pad(tf.cast(mask, tf.uint8), [[0, 0], [0, 0], [0, padded_width - width], [0, 0]])
+    shape = tf.shape(bits)
+    bits = tf.reshape(bits, [shape[0], shape[1], padded_width // 8, 8, shape[3]])
+    weights = tf.constant([128, 64, 32, 16, 8, 4, 2, 1], dtype=tf.uint8)[:, tf.newaxis]
+    return tf.reduce_sum(bits * weights, axis=3), width
+
+def unpack_bits(packed, width):
+    # Host side inverse of pack_bits, returns 0 and 255 values of uint8 type
+    return np.unpackbits(packed, axis=2)[:, :, :width] * np.uint8(255)
 
 class BinarizationWrapper(AbstractModelWrapper):
-    def __init__(self, model, threshold=0.5):
+    def __init__(self, model, threshold=0.5, bit_pack=False):
         self.model = model
         self.threshold = threshold
+        self.bit_pack = bit_pack
+        # Forward pass, threshold and uint8 cast in one graph so that only the mask leaves it
+        self.binarize = tf.function(self._binarize, reduce_retracing=True)
         
     def load_model(self, model_path=None):
         return self.model.load_model(model_path)
+
+    def _binarize(self, input_batch):
+        count_trace('BinarizationWrapper.binarize')
+        mask = self.model.forward(input_batch) > self.threshold
+        if self.bit_pack:
+            return pack_bits(mask)
+        return tf.cast(mask, tf.uint8) * 255
     
     def predict(self, input_data):
-        predictions = self.model.predict(input_data)
-        # binarize using tensorflow so that there are 0 and 255 values of uint8 type
-        return tf.cast(tf.where(predictions > self.threshold, 255, 0), tf.uint8)
-        
\ No newline at end of file
+        if not hasattr(self.model, 'forward'):
+            predictions = self.model.predict(input_data)
+            # binarize using tensorflow so that there are 0 and 255 values of uint8 type
+            return tf.cast(tf.where(predictions > self.threshold, 255, 0), tf.uint8)
+
+        if not isinstance(input_data, tf.data.Dataset):
+            return self.predict_batch(input_data)
+        masks = [self.predict_batch(batch) for batch in input_data]
+        return np.concatenate(masks) if masks else np.empty((0,), dtype=np.uint8)
+
+    def predict_batch(self, input_batch):
+        if not hasattr(self.model, 'forward'):
+            predictions = self.model.predict_batch(input_batch)
+            return tf.cast(tf.where(predictions > self.threshold, 255, 0), tf.uint8)
+
+        if self.bit_pack:
+            packed, width = self.binarize(input_batch)
+            return unpack_bits(packed.numpy(), int(width))
+        return self.binarize(input_batch).numpy()
+
+
+    def predict_probabilities(self, input_batch):
+        # Probabilities before thresholding, for callers that combine overlapping predictions first
+        return np.asarray(self.model.predict_batch(input_batch), dtype=np.float32)
@@ -0,0 +1,89 @@
+"""
+Compares the execution modes of TensorFlowModelWrapper on random input.
+
+Usage: python -m api.analysis.model_wrappers.execution_report <model_path> [--height 512 --width 512 --batch-size 8 --threshold 0.15]
+
+Every mode is compared against the plain Keras predict path the wrappers used before,
+reporting the latency per batch, the throughput and the largest absolute difference
+of the binarized masks.
+"""
+import argparse
+import time
+import logging
+import numpy as np
+import tensorflow as tf
+from api.analysis.model_wrappers.tensorflow_model_wrapper import TensorFlowModelWrapper
+
+logger = logging.getLogger(__name__)
+
+EXECUTION_MODES = {
+    'graph': {},
+    'xla': {'jit_compile': True},
+    'graph+bfloat16': {'mixed_precision': True},
+    'xla+bfloat16': {'jit_compile': True, 'mixed_precision': True},
+}
+
+def binarize(predictions, threshold):
+    return np.where(np.asarray(predictions, dtype=np.float32) > threshold, 255, 0).astype(np.int16)
+
+def time_batches(predict, batch, repeats):
+    # The first call traces and compiles, it is reported separately from the steady state latency
+    start = time.perf_counter()
+    predictions = np.asarray(predict(batch))
+    first_call = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for _ in range(repeats):
+        np.asarray(predict(batch))
+    latency = (time.perf_counter() - start) / repeats
+    return predictions, first_call, latency
+
+def compare_execution_modes(model_path, input_shape, batch_size=8, threshold=0.5, repeats=10, modes=EXECUTION_MODES):
+    """
+    Parameters:
+    model_path: path of the Keras model
+    input_shape: (height, width, channels) of the random input images
+    batch_size: number of images per batch
+    threshold: threshold used to binarize the predictions before comparing them
+    repeats: number of timed batches per mode
+    modes: dictionary of mode name to TensorFlowModelWrapper keyword arguments
+
+    Returns:
+    list of dictionaries with the mode, first call, latency and throughput in seconds and images per second and the max absolute mask difference
+    """
+    batch = tf.random.uniform((batch_size, *input_shape), dtype=tf.float32)
+
+    baseline_model = TensorFlowModelWrapper(model_path).load_model()
+    baseline, first_call, latency = time_batches(lambda x: baseline_model.model.predict(x, verbose=0), batch, repeats)
+    baseline_masks = binarize(baseline, threshold)
+    report = [{'mode': 'keras_predict', 'first_call': first_call, 'latency': latency, 'throughput': batch_size / latency, 'max_abs_mask_diff': 0}]
+
+    for name, options in modes.items():
+        model = TensorFlowModelWrapper(model_path, **options).load_model()
+        if model.execution_mode != name:
+            logger.warning(f"Skipping {name}, the model runs as {model.execution_mode}")
+            continue
+        predictions, first_call, latency = time_batches(model.predict_batch, batch, repeats)
+        report.append({
+            'mode': name,
+            'first_call': first_call,
+            'latency': latency,
+            'throughput': batch_size / latency,
+            'max_abs_mask_diff': int(np.max(np.abs(binarize(predictions, threshold) - baseline_masks))),
+        })
+    return report
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compare TensorFlowModelWrapper execution modes")
+    parser.add_argument('model_path')
+    parser.add_argument('--height', type=int, default=512)
+    parser.add_argument('--width', type=int, default=512)
+    parser.add_argument('--batch-size', type=int, default=8)
+    parser.add_argument('--threshold', type=float, default=0.5)
+    parser.add_argument('--repeats', type=int, default=10)
+    args = parser.parse_args()
+
+    report = compare_execution_modes(args.model_path, (args.height, args.width, 3), args.batch_size, args.threshold, args.repeats)
+    print(f"{'mode':<16}{'first call [s]':>16}{'latency [s]':>14}{'images/s':>12}{'max mask diff':>16}")
+    for row in report:
+        print(f"{row['mode']:<16}{row['first_call']:>16.3f}{row['latency']:>14.4f}{row['throughput']:>12.1f}{row['max_abs_mask_diff']:>16}")
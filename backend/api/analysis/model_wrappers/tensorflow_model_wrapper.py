@@ -1,6 +1,7 @@
 from .abstract_model_wrapper import AbstractModelWrapper
 import tensorflow as tf
 import logging
+from api.analysis.processing.tracing import count_trace
 
 from tensorflow import keras
 
@@ -45,16 +46,60 @@ def iou_loss(y_true, y_pred, smooth=1):
 
 logger = logging.getLogger(__name__)
 
+def cpu_supports_bfloat16():
+    # Native bfloat16 arithmetic needs AVX512-BF16 or AMX, without it bfloat16 is emulated and slower than float32
+    try:
+        with open('/proc/cpuinfo') as cpuinfo:
+            flags = cpuinfo.read()
+    except OSError:
+        return False
+    return 'avx512_bf16' in flags or 'amx_bf16' in flags
+
+def to_mixed_bfloat16(model):
+    # Rebuilds the model with the mixed_bfloat16 policy, variables stay float32 and are copied over
+    def clone_layer(layer):
+        config = layer.get_config()
+        if not isinstance(layer, tf.keras.layers.InputLayer):
+            config['dtype'] = 'mixed_bfloat16'
+        return layer.__class__.from_config(config)
+    mixed_model = tf.keras.models.clone_model(model, clone_function=clone_layer)
+    mixed_model.set_weights(model.get_weights())
+    return mixed_model
+
 class TensorFlowModelWrapper(AbstractModelWrapper):
-    def __init__(self, model_path):
+    def __init__(self, model_path, jit_compile=False, mixed_precision=False):
         self.model_path = model_path
+        self.jit_compile = jit_compile
+        self.mixed_precision = mixed_precision
         
     def load_model(self, model_path=None):
         load_from = model_path if model_path else self.model_path
         logger.info(f"Loading model from {load_from}...")
         self.model = tf.keras.models.load_model(load_from)
         logger.info(f"Loaded model input shape: {self.model.input_shape}, output shape: {self.model.output_shape}")
+        if self.mixed_precision:
+            if cpu_supports_bfloat16():
+                logger.info(f"Running {load_from} in mixed bfloat16 precision")
+                self.model = to_mixed_bfloat16(self.model)
+            else:
+                logger.warning(f"CPU has no native bfloat16 support, running {load_from} in float32")
+                self.mixed_precision = False
+        # Compiled forward pass, called directly to avoid the Keras predict setup on every batch.
+        # XLA executables are specialized to the input shape, so with jit_compile every shape
+        # keeps its own trace instead of being relaxed to a single shape-polymorphic one.
+        self.forward = tf.function(self._forward, reduce_retracing=not self.jit_compile, jit_compile=self.jit_compile)
         return self
 
+    @property
+    def execution_mode(self):
+        return '+'.join(['xla' if self.jit_compile else 'graph'] + (['bfloat16'] if self.mixed_precision else []))
+
+    def _forward(self, inputs):
+        count_trace('TensorFlowModelWrapper.forward')
+        return tf.cast(self.model(inputs, training=False), tf.float32)
+
     def predict(self, input_data):
-        return self.model.predict(input_data)
\ No newline at end of file
+        return self.model.predict(input_data)
+
+    def predict_batch(self, input_batch):
+        return self.forward(input_batch)
\ No newline at end of file
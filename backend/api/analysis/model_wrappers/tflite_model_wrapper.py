@@ -0,0 +1,107 @@
+from .abstract_model_wrapper import AbstractModelWrapper
+import tensorflow as tf
+import numpy as np
+import threading
+import logging
+import glob
+import os
+
+logger = logging.getLogger(__name__)
+
+class TFLiteModelWrapper(AbstractModelWrapper):
+    QUANTIZATION_MODES = (None, 'dynamic_range', 'int8')
+    DEFAULT_CALIBRATION_SHAPE = (512, 512)
+
+    def __init__(self, model_path, quantization=None, calibration_images=None, calibration_shape=DEFAULT_CALIBRATION_SHAPE, cache_dir=None, num_threads=None):
+        """
+        Parameters:
+        model_path: path of a .keras file or a SavedModel directory, converted to TFLite on first load
+        quantization: None, 'dynamic_range' or 'int8'
+        calibration_images: glob pattern of the images used to calibrate int8 quantization
+        calibration_shape: (height, width) the calibration images are resized with padding to
+        cache_dir: directory of the converted .tflite files, defaults to the directory of the model
+        num_threads: number of interpreter threads, defaults to the number of CPUs
+        """
+        if quantization not in self.QUANTIZATION_MODES:
+            raise ValueError(f"quantization must be one of {self.QUANTIZATION_MODES}")
+
+        if quantization == 'int8' and not calibration_images:
+            raise ValueError("int8 quantization requires calibration_images")
+
+        self.model_path = model_path
+        self.quantization = quantization
+        self.calibration_images = calibration_images
+        self.calibration_shape = calibration_shape
+        self.cache_dir = cache_dir
+        self.num_threads = num_threads if num_threads else os.cpu_count()
+        # The interpreter holds the tensors of the last call, so calls must not interleave
+        self.lock = threading.Lock()
+
+    def tflite_path(self, model_path):
+        model_name = os.path.splitext(os.path.basename(os.path.normpath(model_path)))[0]
+        cache_dir = self.cache_dir if self.cache_dir else os.path.dirname(os.path.normpath(model_path))
+        return os.path.join(cache_dir, f"{model_name}.{self.quantization or 'float32'}.tflite")
+
+    def load_model(self, model_path=None):
+        load_from = model_path if model_path else self.model_path
+        tflite_path = self.tflite_path(load_from)
+        if not os.path.exists(tflite_path) or os.path.getmtime(tflite_path) < os.path.getmtime(load_from):
+            logger.info(f"Converting {load_from} to TFLite with quantization {self.quantization}...")
+            flatbuffer = self.convert(load_from)
+            # Written to a temporary file first so that a concurrent load never reads a partial model
+            temporary_path = f"{tflite_path}.{os.getpid()}.tmp"
+            with open(temporary_path, 'wb') as file:
+                file.write(flatbuffer)
+            os.replace(temporary_path, tflite_path)
+
+        logger.info(f"Loading TFLite model from {tflite_path}...")
+        self.interpreter = tf.lite.Interpreter(model_path=tflite_path, num_threads=self.num_threads)
+        self.interpreter.allocate_tensors()
+        self.input_details = self.interpreter.get_input_details()[0]
+        self.output_details = self.interpreter.get_output_details()[0]
+        logger.info(f"Loaded TFLite model input shape: {self.input_details['shape_signature']}, output shape: {self.output_details['shape_signature']}")
+        return self
+
+    def convert(self, model_path):
+        if os.path.isdir(model_path):
+            converter = tf.lite.TFLiteConverter.from_saved_model(model_path)
+        else:
+            converter = tf.lite.TFLiteConverter.from_keras_model(tf.keras.models.load_model(model_path))
+
+        if self.quantization:
+            converter.optimizations = [tf.lite.Optimize.DEFAULT]
+
+        if self.quantization == 'int8':
+            # Inputs and outputs stay float32 so that the pipelines do not change
+            converter.representative_dataset = self.representative_dataset
+            converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+        return converter.convert()
+
+    def representative_dataset(self):
+        image_paths = sorted(glob.glob(self.calibration_images))
+        if not image_paths:
+            raise ValueError(f"no calibration images match {self.calibration_images}")
+
+        for image_path in image_paths:
+            image = tf.io.decode_image(tf.io.read_file(image_path), channels=3, dtype=tf.float32, expand_animations=False)
+            image = tf.image.resize_with_pad(image, self.calibration_shape[0], self.calibration_shape[1])
+            yield [image[tf.newaxis]]
+
+    def predict(self, input_data):
+        if not isinstance(input_data, tf.data.Dataset):
+            return self.predict_batch(input_data)
+        predictions = [self.predict_batch(batch) for batch in input_data]
+        return np.concatenate(predictions) if predictions else np.empty((0,), dtype=np.float32)
+
+    def predict_batch(self, input_batch):
+        input_batch = np.asarray(input_batch, dtype=np.float32)
+        with self.lock:
+            # Dynamic pipelines change the batch and image size, the tensors are reallocated only when it changes
+            if tuple(self.input_details['shape']) != input_batch.shape:
+                self.interpreter.resize_tensor_input(self.input_details['index'], input_batch.shape, strict=False)
+                self.interpreter.allocate_tensors()
+                self.input_details = self.interpreter.get_input_details()[0]
+                self.output_details = self.interpreter.get_output_details()[0]
+            self.interpreter.set_tensor(self.input_details['index'], input_batch)
+            self.interpreter.invoke()
+            return self.interpreter.get_tensor(self.output_details['index'])
@@ -1,15 +1,38 @@
 from abc import ABC, abstractmethod
 from api.analysis.model_wrappers.abstract_model_wrapper import AbstractModelWrapper
+from api.analysis.processing.performance import PerformanceProfile, DEFAULT_PERFORMANCE_PROFILE
+from api.analysis.processing.decoders import ImageDecoder, DEFAULT_IMAGE_DECODER
+from api.analysis.processing.preprocessing import DecodedImageStore
 
 class BaseProcessingPipeline(ABC):
-    def __init__(self, model: AbstractModelWrapper):
+    def __init__(self, model: AbstractModelWrapper, performance_profile: PerformanceProfile = None, image_decoder: ImageDecoder = None):
         if not isinstance(model, AbstractModelWrapper):
             raise TypeError(f"model must be an instance of {AbstractModelWrapper.__name__}")
         self.model = model
+        self.performance_profile = performance_profile if performance_profile else DEFAULT_PERFORMANCE_PROFILE
+        self.image_decoder = image_decoder if image_decoder else DEFAULT_IMAGE_DECODER
         
     def load_model(self):
         return self.model.load_model()
+
+    def decode_images(self, input_images, target_shape=None):
+        return DecodedImageStore.decode(input_images, self.performance_profile, self.image_decoder, target_shape)
     
     @abstractmethod
     def process(self, input_images, **kwargs):
-        pass
\ No newline at end of file
+        """
+        Runs the model on the encoded input images.
+
+        Returns a list of binarized predictions in input order and the DecodedImageStore
+        with the decoded inputs, so that callers never have to decode the images again.
+        Pipelines that accept a stats dict record their run statistics in it.
+        """
+        pass
+
+    def process_stream(self, input_images, **kwargs):
+        """
+        Same as process, but returns the predictions as an iterator. Pipelines that can
+        produce predictions image by image override this to keep memory bounded.
+        """
+        predictions, images = self.process(input_images, **kwargs)
+        return iter(predictions), images
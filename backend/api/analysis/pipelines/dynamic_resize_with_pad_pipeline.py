@@ -1,55 +1,73 @@
 from api.analysis.pipelines.base_processing_pipeline import BaseProcessingPipeline
-from api.analysis.processing.preprocessing import load_images_dataset, resize_with_pad, get_image_dimensions, round_up
+from api.analysis.processing.preprocessing import resize_with_pad, round_up, group_by_shape
 import logging
 from api.analysis.processing.postprocessing import calculate_padding_and_resize
-import tensorflow as tf
 logger = logging.getLogger(__name__)
 
 class DynamicResizeWithPadPipeline(BaseProcessingPipeline):
     DEFAULT_BATCH_SIZE = 32
-    def __init__(self, model, downsampling_factor, batch_size=DEFAULT_BATCH_SIZE):
+    def __init__(self, model, downsampling_factor, batch_size=DEFAULT_BATCH_SIZE, bucketing=True, performance_profile=None, image_decoder=None):
         if downsampling_factor < 1 or not isinstance(downsampling_factor, int):
             raise ValueError("downsampling_factor must be a positive integer")
             
         if not isinstance(batch_size, int) and batch_size < 1:
             raise ValueError("batch_size must be a positive integer")
         
-        super().__init__(model)
+        super().__init__(model, performance_profile, image_decoder)
         self.downsampling_factor = downsampling_factor
         self.batch_size = batch_size
+        # group images by their own rounded shape instead of resizing all of them to the largest one
+        self.bucketing = bucketing
 
-    def process(self, input_images):
+    def process(self, input_images, stats=None):
         logger.debug(f"Starting DynamicResizeWithPadPipeline")
         logger.debug(f"Loading images...")
-        images_dataset = load_images_dataset(input_images)
+        images = self.decode_images(input_images)
 
-        original_shapes = list(images_dataset.map(get_image_dimensions).as_numpy_iterator())
+        target_shapes = self.target_shapes(images.shapes)
+        buckets = group_by_shape(target_shapes)
+        logger.debug(f"Grouped {len(images)} images into {len(buckets)} buckets")
 
-        # Get the maximum height and width
-        max_height = tf.reduce_max([shape[0] for shape in original_shapes])
-        max_width = tf.reduce_max([shape[1] for shape in original_shapes])
+        original_shaped_predictions = [None] * len(images)
+        for (target_height, target_width), indices in buckets.items():
+            logger.debug(f"Resizing {len(indices)} images with padding to shape ({target_height}, {target_width})...")
+            resized_dataset = self.performance_profile.map(images.as_dataset(indices), lambda image: resize_with_pad(image, target_height, target_width))
 
-        logger.debug(f"max_height: {max_height}, max_width: {max_width}")
+            logger.debug(f"Batching images into batches of size {self.batch_size}...")
+            batched_resized_dataset = self.performance_profile.finalize(resized_dataset.batch(self.batch_size))
 
-        target_height = round_up(max_height, self.downsampling_factor)
-        target_width = round_up(max_width, self.downsampling_factor)
+            logger.debug(f"Making predictions...")
+            predictions = self.model.predict(batched_resized_dataset) # uint8 array of shape (n, target_height, target_width, 1)
 
-        logger.debug(f"Resizing with padding to shape ({target_height}, {target_width})...")
-        resized_dataset = images_dataset.map(lambda image: resize_with_pad(image, target_height, target_width))
+            logger.debug(f"Resizing predictions to original shapes...")
+            for index, prediction in zip(indices, predictions):
+                original_shape = images.shapes[index]
+                original_shaped_predictions[index] = calculate_padding_and_resize(prediction, target_height, target_width, original_shape[0], original_shape[1])
 
-        logger.debug(f"Batching images into batches of size {self.batch_size}...")
-        batched_resized_dataset = resized_dataset.batch(self.batch_size)
+        if stats is not None:
+            stats['buckets'] = len(buckets)
+            stats['padding_overhead_percent'] = padding_overhead_percent(images.shapes, target_shapes)
 
-        logger.debug(f"Making predictions...")
-        predictions = self.model.predict(batched_resized_dataset) # numpy array of shape (n, patch_size, patch_size, 1) float32 in range [0, 1]
+        return original_shaped_predictions, images
 
-        logger.debug(f"Resizing predictions to original shapes...")
-        original_shaped_predictions = []
-        for original_shape, prediction in zip(original_shapes, predictions):
-            original_shaped_prediction = calculate_padding_and_resize(prediction, target_height, target_width, original_shape[0], original_shape[1])
-            original_shaped_predictions.append(original_shaped_prediction)
+    def target_shapes(self, original_shapes):
+        if self.bucketing:
+            return [(round_up(height, self.downsampling_factor), round_up(width, self.downsampling_factor)) for height, width in original_shapes]
 
-        return original_shaped_predictions, images_dataset
+        # Every image is resized to the largest height and width in the request
+        max_height = max(shape[0] for shape in original_shapes)
+        max_width = max(shape[1] for shape in original_shapes)
+        logger.debug(f"max_height: {max_height}, max_width: {max_width}")
+        target_shape = (round_up(max_height, self.downsampling_factor), round_up(max_width, self.downsampling_factor))
+        return [target_shape] * len(original_shapes)
     
     def load_model(self):
-        super().load_model()
\ No newline at end of file
+        super().load_model()
+
+def padding_overhead_percent(original_shapes, target_shapes):
+    # Share of the pixels processed by the model that are not pixels of the original images
+    original_pixels = sum(height * width for height, width in original_shapes)
+    target_pixels = sum(height * width for height, width in target_shapes)
+    if target_pixels == 0:
+        return 0.0
+    return max(target_pixels - original_pixels, 0) / target_pixels * 100
@@ -1,4 +1,4 @@
-from api.analysis.processing.preprocessing import load_image
+from api.analysis.processing.preprocessing import DecodedImageStore
 from api.analysis.pipelines.base_processing_pipeline import BaseProcessingPipeline
 import tensorflow as tf
 import os
@@ -16,5 +16,4 @@ class MockModelPipeline(BaseProcessingPipeline):
         bytes = tf.io.read_file(self.prediction_image_path)
         image = image = tf.io.decode_image(bytes, channels=1, dtype=tf.float32)
         image_2d = tf.squeeze(image, axis=-1)
-        dataset = tf.data.Dataset.from_tensor_slices([image_2d]) # dataset of bytes
-        return [image_2d.numpy()], dataset
\ No newline at end of file
+        return [image_2d.numpy()], DecodedImageStore([image_2d.numpy()])
\ No newline at end of file
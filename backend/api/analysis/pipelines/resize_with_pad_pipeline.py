@@ -1,5 +1,5 @@
 from api.analysis.pipelines.base_processing_pipeline import BaseProcessingPipeline
-from api.analysis.processing.preprocessing import load_images_dataset, resize_with_pad, get_image_dimensions
+from api.analysis.processing.preprocessing import resize_with_pad
 import logging
 from api.analysis.processing.postprocessing import calculate_padding_and_resize
 
@@ -7,39 +7,42 @@ logger = logging.getLogger(__name__)
 
 class ResizeWithPadPipeline(BaseProcessingPipeline):
     DEFAULT_BATCH_SIZE = 32
-    def __init__(self, model, target_dimensions, batch_size=DEFAULT_BATCH_SIZE):
+    def __init__(self, model, target_dimensions, batch_size=DEFAULT_BATCH_SIZE, reduced_decode=True, performance_profile=None, image_decoder=None):
         if len(target_dimensions) != 2 or not all(isinstance(dim, int) and dim > 0 for dim in target_dimensions):
             raise ValueError("target_dimensions must be a tuple of two positive integers")
         
         if not isinstance(batch_size, int) and batch_size < 1:
             raise ValueError("batch_size must be a positive integer")
         
-        super().__init__(model)
+        super().__init__(model, performance_profile, image_decoder)
         self.target_dimensions = target_dimensions
         self.batch_size = batch_size
+        # decode at 1/2, 1/4 or 1/8 resolution when the source is much larger than the target
+        self.reduced_decode = reduced_decode
 
-    def process(self, input_images):
+    def process(self, input_images, stats=None):
         logger.debug(f"Starting ResizeWithPadPipeline")
         logger.debug(f"Loading images...")
-        images_dataset = load_images_dataset(input_images)
+        images = self.decode_images(input_images, target_shape=self.target_dimensions if self.reduced_decode else None)
+        if stats is not None:
+            stats['reduced_decodes'] = sum(factor > 1 for factor in images.reduction_factors)
         
         logger.debug(f"Resizing with padding to shape {self.target_dimensions}...")
-        resized_dataset = images_dataset.map(lambda image: resize_with_pad(image, self.target_dimensions[0], self.target_dimensions[1]))
+        resized_dataset = self.performance_profile.map(images.as_dataset(), lambda image: resize_with_pad(image, self.target_dimensions[0], self.target_dimensions[1]))
         
         logger.debug(f"Batching images into batches of size {self.batch_size}...")
-        batched_resized_dataset = resized_dataset.batch(self.batch_size)
+        batched_resized_dataset = self.performance_profile.finalize(resized_dataset.batch(self.batch_size))
         
         logger.debug(f"Making predictions...")
         predictions = self.model.predict(batched_resized_dataset) # numpy array of shape (n, patch_size, patch_size, 1) float32 in range [0, 1]
         
         logger.debug(f"Resizing predictions to original shapes...")
-        original_shapes = images_dataset.map(get_image_dimensions)
         original_shaped_predictions = []
-        for original_shape, prediction in zip(original_shapes, predictions):
+        for original_shape, prediction in zip(images.shapes, predictions):
             original_shaped_prediction = calculate_padding_and_resize(prediction, self.target_dimensions[0], self.target_dimensions[1], original_shape[0], original_shape[1])
             original_shaped_predictions.append(original_shaped_prediction)
         
-        return original_shaped_predictions, images_dataset
+        return original_shaped_predictions, images
     
     def load_model(self):
         super().load_model()
\ No newline at end of file
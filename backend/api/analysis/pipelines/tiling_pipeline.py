@@ -1,42 +1,110 @@
 from api.analysis.pipelines.base_processing_pipeline import BaseProcessingPipeline
-from api.analysis.processing.preprocessing import load_images_dataset, pad_dataset, split_images_into_patches
-from api.analysis.processing.postprocessing import recombine_patches
+from api.analysis.processing.preprocessing import DecodedImageStore, apply_padding_and_return_shape, extract_patches_and_find_background, to_model_input
+from api.analysis.processing.postprocessing import TileCanvas
+import numpy as np
+import tensorflow as tf
 import logging
 
 logger = logging.getLogger(__name__)
 
 class TilingPipeline(BaseProcessingPipeline):
     DEFAULT_BATCH_SIZE = 32
-    def __init__(self, model, patch_size, batch_size=DEFAULT_BATCH_SIZE):
+    DEFAULT_BACKGROUND_STD = 0.01
+    def __init__(self, model, patch_size, batch_size=DEFAULT_BATCH_SIZE, overlap=0, background_std=DEFAULT_BACKGROUND_STD, image_decoder=None):
         if len(patch_size) != 3 or not all(isinstance(dim, int) and dim > 0 for dim in patch_size):
             raise ValueError("patch_size must be a tuple of three positive integers")
         
         if not isinstance(batch_size, int) and batch_size < 1:
             raise ValueError("batch_size must be a positive integer")
         
-        super().__init__(model)
+        if not isinstance(overlap, int) or overlap < 0 or overlap >= min(patch_size[:2]):
+            raise ValueError("overlap must be a non-negative integer smaller than the patch size")
+        
+        if background_std is not None and background_std < 0:
+            raise ValueError("background_std must be a non-negative number or None")
+        
+        if overlap and not hasattr(model, 'predict_probabilities'):
+            raise ValueError("overlap needs a model wrapper with predict_probabilities, overlapping tiles are blended before thresholding")
+        
+        super().__init__(model, image_decoder=image_decoder)
+        # No tf.data pipeline is built, so there is no performance profile to apply or report
+        self.performance_profile = None
         self.patch_size = patch_size
         self.batch_size = batch_size
+        self.overlap = overlap
+        self.strides = (patch_size[0] - overlap, patch_size[1] - overlap)
+        # patches with a standard deviation below background_std skip the model, None disables skipping
+        self.background_std = background_std
 
-    def process(self, input_images):
+    def process(self, input_images, stats=None):
+        predictions, images = self.process_stream(input_images, stats=stats)
+        return list(predictions), images
+
+    def process_stream(self, input_images, stats=None):
         logger.debug(f"Starting TilingPipeline")
         logger.debug(f"Loading images...")
-        images_dataset = load_images_dataset(input_images)
+        # Images are decoded while the predictions are consumed, the next one ahead on the decoder's pool
+        images = DecodedImageStore.deferred(input_images, self.image_decoder)
+        return self.stream(images, stats=stats), images
+
+    def stream(self, images, stats=None):
+        """
+        Yields recombined predictions image by image.
+
+        Images are decoded as the predictions are consumed, patches of one image are
+        predicted in batches of batch_size and written straight into a preallocated
+        canvas. With a deferred store only the current image, the image decoded ahead
+        and one canvas are held at a time. When the encoded inputs are fetched lazily as well, peak memory
+        depends on the batch size and the largest image, not on the number of images in
+        the request.
+
+        Background patches are not sent to the model, they are recombined as empty
+        predictions. The number of patches and skipped patches is recorded in stats.
+        """
+        stats = {} if stats is None else stats
+        stats.update(tiles_total=0, tiles_skipped=0, tile_skip_ratio=0.0)
+        for index in range(len(images)):
+            image = images.image(index)
+            yield self.predict_image(image, image.shape[:2], stats)
+
+    def predict_image(self, image, original_shape, stats):
+        patch_height, patch_width = self.patch_size[:2]
+        stride_height, stride_width = self.strides
         
         logger.debug(f"Padding...")
-        padded_dataset, original_shapes = pad_dataset(images_dataset, self.patch_size)
+        padded_image, _ = apply_padding_and_return_shape(image, self.patch_size, self.strides)
+        grid_height = (padded_image.shape[0] - patch_height) // stride_height + 1
+        grid_width = (padded_image.shape[1] - patch_width) // stride_width + 1
+        
+        # Overlapping tiles are blended as probabilities and thresholded once, without overlap the model binarizes
+        blend = self.overlap > 0
+        canvas = TileCanvas(padded_image.shape[0], padded_image.shape[1], patch_height, patch_width, blend=blend, threshold=self.model.threshold if blend else 0.5)
+        predict = self.model.predict_probabilities if blend else self.model.predict
+        
+        patches, background = extract_patches_and_find_background(padded_image, self.patch_size, self.strides, -1.0 if self.background_std is None else self.background_std)
+        background = background.numpy()
+        foreground_indices = np.flatnonzero(~background)
         
-        logger.debug(f"Splitting...")
-        patched_images_dataset, patch_counts = split_images_into_patches(padded_dataset, self.patch_size)
+        logger.debug(f"Recombining {np.count_nonzero(background)} background patches...")
+        empty_prediction = np.zeros((patch_height, patch_width, 1), dtype=np.float32 if blend else np.uint8)
+        for patch_index in np.flatnonzero(background):
+            row, column = divmod(patch_index, grid_width)
+            canvas.add(empty_prediction, row * stride_height, column * stride_width)
         
-        logger.debug(f"Batching images into batches of size {self.batch_size}...")
-        patched_images_dataset = patched_images_dataset.batch(self.batch_size)
+        logger.debug(f"Making predictions for {len(foreground_indices)} of {grid_height * grid_width} patches in batches of size {self.batch_size}...")
+        for start_index in range(0, len(foreground_indices), self.batch_size):
+            batch_indices = foreground_indices[start_index:start_index + self.batch_size]
+            predictions = np.asarray(predict(to_model_input(tf.gather(patches, batch_indices)))) # uint8 masks or float32 probabilities of shape (batch_size, patch_size, patch_size, 1)
+            for patch_index, prediction in zip(batch_indices, predictions):
+                row, column = divmod(patch_index, grid_width)
+                canvas.add(prediction, row * stride_height, column * stride_width)
         
-        logger.debug(f"Making predictions...")
-        predictions = self.model.predict(patched_images_dataset) # numpy array of shape (n, patch_size, patch_size, 1) float32 in range [0, 1]
+        stats['tiles_total'] += len(background)
+        stats['tiles_skipped'] += len(background) - len(foreground_indices)
+        stats['tile_skip_ratio'] = stats['tiles_skipped'] / stats['tiles_total']
         
-        logger.debug(f"Recombining...")
-        return recombine_patches(predictions, original_shapes, patch_counts, self.patch_size), images_dataset
+        # crop image to remove padding
+        return canvas.crop(original_shape[0], original_shape[1])
     
     def load_model(self):
-        super().load_model()
\ No newline at end of file
+        super().load_model()
@@ -1,5 +1,5 @@
 from api.analysis.pipelines.base_processing_pipeline import BaseProcessingPipeline
-from api.analysis.processing.preprocessing import load_images_dataset, add_dimension, resize_to_next_divisor, get_image_dimensions
+from api.analysis.processing.preprocessing import resize_to_next_divisor, round_up, group_by_shape
 import logging
 from api.analysis.processing.postprocessing import calculate_padding_and_resize
 
@@ -7,44 +7,55 @@ logger = logging.getLogger(__name__)
 
 class VariableShapePipeline(BaseProcessingPipeline):
     DEFAULT_BATCH_SIZE = 32
-    def __init__(self, model, downsampling_factor, batch_size=DEFAULT_BATCH_SIZE):
+    def __init__(self, model, downsampling_factor, batch_size=DEFAULT_BATCH_SIZE, performance_profile=None, image_decoder=None):
         if downsampling_factor < 1 or not isinstance(downsampling_factor, int):
             raise ValueError("downsampling_factor must be a positive integer")
             
         if not isinstance(batch_size, int) and batch_size < 1:
             raise ValueError("batch_size must be a positive integer")
         
-        super().__init__(model)
+        super().__init__(model, performance_profile, image_decoder)
         self.downsampling_factor = downsampling_factor
         self.batch_size = batch_size
 
-    def process(self, input_images):
+    def process(self, input_images, stats=None):
         logger.debug(f"Starting VariableShapePipeline")
         logger.debug(f"Loading images...")
-        images_dataset = load_images_dataset(input_images)
+        images = self.decode_images(input_images)
         
-        logger.debug(f"Resizing with padding...")
-        resized_images_and_original_shapes = images_dataset.map(lambda image: resize_to_next_divisor(image, divisor=self.downsampling_factor))
-        resized_dataset = resized_images_and_original_shapes.map(lambda x, y: x)
-        original_shapes = resized_images_and_original_shapes.map(lambda x, y: y)
+        original_shapes = images.shapes
         
-        resized_shapes = resized_dataset.map(get_image_dimensions)
+        # Same rounding as resize_to_next_divisor, known without iterating the resized images
+        resized_shapes = [(round_up(height, self.downsampling_factor), round_up(width, self.downsampling_factor)) for height, width in original_shapes]
         for resized_shape, original_shape in zip(resized_shapes, original_shapes):
             logger.debug(f"resized_shape: {resized_shape}, original_shape: {original_shape}")
-
-        logger.debug(f"Adding dimension...")
-        resized_dataset = resized_dataset.batch(1)
         
-        logger.debug(f"Making predictions...")
-        predictions = self.model.predict(resized_dataset) # numpy array of shape (n, patch_size, patch_size, 1) float32 in range [0, 1]
+        # Images with the same resized shape are predicted together
+        groups = group_by_shape(resized_shapes)
+        logger.debug(f"Grouped {len(images)} images into {len(groups)} shape groups")
+        
+        original_shaped_predictions = [None] * len(images)
+        model_calls = 0
+        for (resized_height, resized_width), indices in groups.items():
+            logger.debug(f"Resizing {len(indices)} images with padding to shape ({resized_height}, {resized_width})...")
+            resized_dataset = self.performance_profile.map(images.as_dataset(indices), lambda image: resize_to_next_divisor(image, divisor=self.downsampling_factor)[0])
+            
+            logger.debug(f"Making predictions in batches of size {self.batch_size}...")
+            predictions = []
+            for batch in self.performance_profile.finalize(resized_dataset.batch(self.batch_size)):
+                predictions.extend(self.model.predict_batch(batch)) # uint8 tensors of shape (resized_height, resized_width, 1)
+                model_calls += 1
+            
+            logger.debug(f"Resizing predictions...")
+            for index, prediction in zip(indices, predictions):
+                original_shape = original_shapes[index]
+                original_shaped_predictions[index] = calculate_padding_and_resize(prediction, resized_height, resized_width, original_shape[0], original_shape[1])
         
-        logger.debug(f"Resizing predictions...")
-        original_shaped_predictions = []
-        for original_shape, resized_shape, prediction in zip(original_shapes, resized_shapes, predictions):
-            original_shaped_prediction = calculate_padding_and_resize(prediction, resized_shape[0], resized_shape[1], original_shape[0], original_shape[1])
-            original_shaped_predictions.append(original_shaped_prediction)
+        if stats is not None:
+            stats['shape_groups'] = len(groups)
+            stats['model_calls'] = model_calls
         
-        return original_shaped_predictions, images_dataset
+        return original_shaped_predictions, images
     
     def load_model(self):
         super().load_model()
\ No newline at end of file
@@ -0,0 +1,164 @@
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from gevent import monkey
+from gevent.threadpool import ThreadPoolExecutor as NativeThreadPoolExecutor
+import threading
+import io
+import os
+import tensorflow as tf
+import numpy as np
+import cv2
+from PIL import Image
+from api.analysis.processing.tracing import count_trace, count_decodes
+
+# Scale denominators supported by libjpeg's DCT scaling
+REDUCTION_FACTORS = (1, 2, 4, 8)
+JPEG_FORMATS = ('JPEG', 'MPO')
+
+@tf.function(input_signature=[tf.TensorSpec(shape=[], dtype=tf.string)])
+def load_image(bytes):
+    count_trace('load_image')
+    # Images stay uint8 until they are batched for the model
+    image = tf.io.decode_image(bytes, channels=3, dtype=tf.uint8, expand_animations=False)
+    return image
+
+@tf.function(input_signature=[tf.TensorSpec(shape=[], dtype=tf.string), tf.TensorSpec(shape=[], dtype=tf.int32)])
+def load_image_reduced(bytes, factor):
+    count_trace('load_image_reduced')
+    # JPEGs only, libjpeg scales them while decoding
+    def decode_jpeg(ratio):
+        return lambda: tf.io.decode_jpeg(bytes, channels=3, ratio=ratio)
+
+    ratio_index = tf.argmax(tf.cast(tf.equal(REDUCTION_FACTORS, factor), tf.int32), output_type=tf.int32)
+    return tf.switch_case(ratio_index, [decode_jpeg(ratio) for ratio in REDUCTION_FACTORS])
+
+def probe_image(image_bytes):
+    """Reads the (height, width) and the format from the image header without decoding the pixels."""
+    with Image.open(io.BytesIO(image_bytes)) as image:
+        return (image.height, image.width), image.format
+
+def reduction_factor(shape, target_shape):
+    """
+    Largest supported factor the image can be shrunk by before it is resized with padding to target_shape.
+
+    resize_with_pad scales by min(target_height / height, target_width / width), so any factor up to
+    max(height / target_height, width / target_width) keeps the final resize a downscale.
+    """
+    max_factor = max(shape[0] / target_shape[0], shape[1] / target_shape[1])
+    return max(factor for factor in REDUCTION_FACTORS if factor <= max_factor)
+
+def decoding_executor(max_workers=None):
+    # The gevent worker patches threading, its executor keeps using OS threads so that decoding still runs on several cores
+    if monkey.is_module_patched('threading'):
+        return NativeThreadPoolExecutor(max_workers=max_workers or os.cpu_count() or 1)
+    return ThreadPoolExecutor(max_workers=max_workers)
+
+class ImageDecoder(ABC):
+    name = None
+
+    def decode(self, image_bytes, factor=1):
+        """Decodes a single image into a uint8 RGB array of shape [height, width, 3], a factor above 1 needs a JPEG."""
+        image = self.decode_image(image_bytes, factor)
+        count_decodes()
+        return image
+
+    @abstractmethod
+    def decode_image(self, image_bytes, factor=1):
+        pass
+
+    @abstractmethod
+    def decode_all(self, image_bytes_list, performance_profile, factors=None):
+        """Decodes encoded images into uint8 RGB arrays of shape [height, width, 3], in input order."""
+        pass
+
+    def decode_later(self, image_bytes, factor=1):
+        """
+        Starts decoding an image and returns a function that waits for the decoded image.
+
+        The decode is counted when it is waited for. Decoders without a pool decode when
+        the function is called.
+        """
+        return lambda: self.decode(image_bytes, factor)
+
+    def plan(self, image_bytes_list, target_shape):
+        """
+        Probes the image headers and picks a reduction factor per image.
+
+        Only JPEGs are decoded at a reduced resolution. Any other format would be decoded
+        in full and shrunk, and then decoded in full a second time for its original, so
+        it keeps a factor of 1. Returns the full resolution shapes and the factors.
+        """
+        shapes, factors = [], []
+        for image_bytes in image_bytes_list:
+            shape, image_format = probe_image(image_bytes)
+            shapes.append(shape)
+            factors.append(reduction_factor(shape, target_shape) if image_format in JPEG_FORMATS else 1)
+        return shapes, factors
+
+class TensorFlowImageDecoder(ImageDecoder):
+    name = 'tensorflow'
+
+    def decode_image(self, image_bytes, factor=1):
+        if factor == 1:
+            return load_image(image_bytes).numpy()
+        return load_image_reduced(image_bytes, factor).numpy()
+
+    def decode_all(self, image_bytes_list, performance_profile, factors=None):
+        # Decode in parallel, every image carries its index so the completion order does not matter
+        if factors is None:
+            dataset = tf.data.Dataset.from_tensor_slices(image_bytes_list).enumerate()
+            dataset = performance_profile.map(dataset, lambda index, image_bytes: (index, load_image(image_bytes)), ordered=False)
+        else:
+            # Images that are not reduced keep the generic decoder, load_image_reduced only decodes JPEGs
+            dataset = tf.data.Dataset.from_tensor_slices((image_bytes_list, tf.constant(factors, dtype=tf.int32))).enumerate()
+            dataset = performance_profile.map(dataset, lambda index, inputs: (index, tf.cond(inputs[1] > 1, lambda: load_image_reduced(*inputs), lambda: load_image(inputs[0]))), ordered=False)
+        dataset = performance_profile.finalize(dataset)
+
+        images = [None] * len(image_bytes_list)
+        for index, image in dataset:
+            images[int(index)] = image.numpy()
+            count_decodes()
+        return images
+
+class OpenCVImageDecoder(ImageDecoder):
+    name = 'opencv'
+    # EXIF orientation is ignored like in the TensorFlow decoder and the PIL probe, so that shapes agree across them
+    REDUCED_FLAGS = {factor: flag | cv2.IMREAD_IGNORE_ORIENTATION for factor, flag in
+                     {1: cv2.IMREAD_COLOR, 2: cv2.IMREAD_REDUCED_COLOR_2, 4: cv2.IMREAD_REDUCED_COLOR_4, 8: cv2.IMREAD_REDUCED_COLOR_8}.items()}
+
+    def __init__(self, max_workers=None):
+        # cv2.imdecode releases the GIL, so a thread pool decodes on several cores
+        self.max_workers = max_workers
+        self.executor = None
+        self.lock = threading.Lock()
+
+    def pool(self):
+        # Created on first use and shared by the tasks of the worker, so that no decode waits for threads to start
+        with self.lock:
+            if self.executor is None:
+                self.executor = decoding_executor(self.max_workers)
+            return self.executor
+
+    def decode_image(self, image_bytes, factor=1):
+        # libjpeg scales JPEGs while decoding, the reduced flags would subsample other formats
+        image = cv2.imdecode(np.frombuffer(image_bytes, dtype=np.uint8), self.REDUCED_FLAGS[factor])
+        if image is None:
+            raise ValueError("could not decode image!")
+        return cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+
+    def decode_all(self, image_bytes_list, performance_profile, factors=None):
+        factors = factors if factors is not None else [1] * len(image_bytes_list)
+        # The pool threads do not share the caller's decode counter, so the decodes are counted once they are collected
+        images = list(self.pool().map(self.decode_image, image_bytes_list, factors))
+        count_decodes(len(images))
+        return images
+
+    def decode_later(self, image_bytes, factor=1):
+        future = self.pool().submit(self.decode_image, image_bytes, factor)
+        def result():
+            image = future.result()
+            count_decodes()
+            return image
+        return result
+
+DEFAULT_IMAGE_DECODER = TensorFlowImageDecoder()
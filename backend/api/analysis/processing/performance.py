@@ -0,0 +1,54 @@
+import tensorflow as tf
+
+class PerformanceProfile:
+    """
+    tf.data settings applied to the datasets a pipeline builds.
+
+    Parameters:
+    name (str): Name reported in the task result.
+    num_parallel_calls (int or None): Parallelism of dataset.map, tf.data.AUTOTUNE lets tf.data pick it, None runs maps sequentially.
+    prefetch (int): Number of elements prepared ahead of the consumer, tf.data.AUTOTUNE lets tf.data pick it, 0 disables prefetching.
+    deterministic (bool): Whether parallel maps keep the element order. Only stages that restore the order
+        themselves (image decoding) use it, datasets whose order the pipeline relies on stay deterministic.
+    private_threadpool_size (int): Size of a dedicated tf.data threadpool, 0 uses the shared one.
+    max_intra_op_parallelism (int): Maximum threads a single tf.data op may use, 0 leaves it to TensorFlow.
+    """
+    def __init__(self, name='default', num_parallel_calls=tf.data.AUTOTUNE, prefetch=tf.data.AUTOTUNE, deterministic=True, private_threadpool_size=0, max_intra_op_parallelism=0):
+        self.name = name
+        self.num_parallel_calls = num_parallel_calls
+        self.prefetch = prefetch
+        self.deterministic = deterministic
+        self.private_threadpool_size = private_threadpool_size
+        self.max_intra_op_parallelism = max_intra_op_parallelism
+
+    def map(self, dataset, function, ordered=True):
+        deterministic = True if ordered else self.deterministic
+        return dataset.map(function, num_parallel_calls=self.num_parallel_calls, deterministic=deterministic)
+
+    def finalize(self, dataset):
+        # Applies the threading options and prefetches, so preprocessing overlaps with the consumer
+        options = tf.data.Options()
+        if self.private_threadpool_size:
+            options.threading.private_threadpool_size = self.private_threadpool_size
+        if self.max_intra_op_parallelism:
+            options.threading.max_intra_op_parallelism = self.max_intra_op_parallelism
+        dataset = dataset.with_options(options)
+
+        if self.prefetch:
+            dataset = dataset.prefetch(self.prefetch)
+        return dataset
+
+    def as_dict(self):
+        def describe(value):
+            return 'autotune' if value == tf.data.AUTOTUNE else value
+
+        return {
+            'name': self.name,
+            'num_parallel_calls': describe(self.num_parallel_calls),
+            'prefetch': describe(self.prefetch),
+            'deterministic': self.deterministic,
+            'private_threadpool_size': self.private_threadpool_size,
+            'max_intra_op_parallelism': self.max_intra_op_parallelism,
+        }
+
+DEFAULT_PERFORMANCE_PROFILE = PerformanceProfile()
@@ -1,6 +1,8 @@
 import numpy as np
 import tensorflow as tf
 import logging
+import functools
+from api.analysis.processing.tracing import count_trace
 import cv2
 from skimage.morphology import skeletonize
 
@@ -8,74 +10,94 @@ logger = logging.getLogger(__name__)
 
 
 def overlay_masks(image, reference, prediction, reference_color = (1, 0, 0), prediction_color = (1, 1, 0), overlap_color = (0, 1, 0), alpha=0.6):
+    """
+    Blends reference and prediction masks over an image using per-colour lookup tables.
+
+    Parameters:
+    image (np.ndarray): uint8 RGB image of shape [..., height, width, 3], leading dimensions are treated as a batch.
+    reference (np.ndarray or None): uint8 reference mask, pixels above 127 are foreground. None skips the reference entirely.
+    prediction (np.ndarray): Binarized prediction mask, non-zero pixels are foreground.
+
+    Returns:
+    np.ndarray: uint8 RGB image of the same shape as image.
+    """
     logger.debug(f"Original image shape: {image.shape}")
-    logger.debug(f"Reference shape: {reference.shape}")
+    logger.debug(f"Reference shape: {None if reference is None else reference.shape}")
     logger.debug(f"Prediction shape: {prediction.shape}")
-    
-    # Convert float masks to boolean
-    mask1_bool = reference > 0.5
-    mask2_bool = prediction > 0
-
-    #logger.debug(f" After bool")
-    # Reshape masks to 3D (x, y, 1)
-    mask1_3d = tf.cast(mask1_bool, tf.float32)
-    mask2_3d = tf.cast(mask2_bool, tf.float32)
-
-    #logger.debug(f" After 3d")
-    # Apply colors to masks
-    mask1_colored = mask1_3d * reference_color
-    mask2_colored = mask2_3d * prediction_color
-    #logger.debug(f" After colored")
-    # Determine overlapping area and apply overlap color
-    overlap_mask = tf.math.logical_and(mask1_bool, mask2_bool)    
-
-    #overlap_colored = tf.cast(overlap_mask, tf.float32) * overlap_color
-    #logger.debug(f" After overlap")
-    # Combine masks
-    combined_masks = mask1_colored + mask2_colored
-    #logger.debug(f" After combine")
-    # Apply overlap color to the overlapping areas
-    combined_masks = tf.where(tf.cast(overlap_mask, tf.bool), overlap_color, combined_masks)
-    #logger.debug(f" After where")
-    combined_mask_area = tf.math.logical_or(mask1_bool, mask2_bool)
-    #logger.debug(f" After logical")
-    # Convert to float for blending
-    combined_mask_area_float = tf.cast(combined_mask_area, tf.float32)
-    #logger.debug(f" After float")
-    # Apply the alpha blending only to areas with masks
-    overlayed_image = image * (1 - combined_mask_area_float * alpha) + combined_masks * (combined_mask_area_float * alpha)
-    #logger.debug(f" After overlay")
-    return overlayed_image
 
-
-def recombine_patches(predictions, original_shapes, patch_counts, patch_size):
-    recombined_images = []
-    start_index = 0
-    
-    for (original_height, original_width), patch_count in zip(original_shapes, patch_counts):
-        
-        # Calculate the number of patches along each dimension
-        num_patches_height = int(np.ceil(original_height / patch_size[1]))
-        num_patches_width = int(np.ceil(original_width / patch_size[0]))
-        #logger.debug(f"calculated patch_size: {(num_patches_height * num_patches_width)}")
-        current_patches = predictions[start_index:start_index + num_patches_height * num_patches_width]
-        #logger.debug(f"current_patches.shape: {current_patches.shape}")
-        start_index += patch_count
-        
-        # Reshape the patches to align in a grid
-        reshaped_patches = tf.reshape(current_patches, [num_patches_height, num_patches_width, patch_size[0], patch_size[1], 1])
-
-        # Rearrange the patches and merge them
-        recombined_image = tf.transpose(reshaped_patches, [0, 2, 1, 3, 4])
-        recombined_image = tf.reshape(recombined_image, [num_patches_height * patch_size[0], num_patches_width * patch_size[1], 1])
-        #logger.debug(f'recombined_image type after reshaping: {type(recombined_image)}')
-        # crop image to remove padding
-        recombined_image = recombined_image[:original_height, :original_width]
-        #logger.debug(f'recombined_image type after cropping: {type(recombined_image)}')
-        # Add to the list of recombined images
-        recombined_images.append(recombined_image)
-        
-    return recombined_images
+    prediction_mask = _as_mask(prediction, image.ndim) > 0
+    prediction_overlay = _apply_lut(image, overlay_lut(prediction_color, alpha))
+
+    if reference is None:
+        return np.where(prediction_mask[..., np.newaxis], prediction_overlay, image)
+
+    reference_mask = _as_mask(reference, image.ndim) > 127
+
+    # 0 - no mask, 1 - reference only, 2 - prediction only, 3 - overlap
+    mask_classes = reference_mask.astype(np.uint8) + 2 * prediction_mask.astype(np.uint8)
+    choices = [image, _apply_lut(image, overlay_lut(reference_color, alpha)), prediction_overlay, _apply_lut(image, overlay_lut(overlap_color, alpha))]
+    return np.choose(mask_classes[..., np.newaxis], choices)
+
+@functools.lru_cache(maxsize=None)
+def overlay_lut(color, alpha):
+    # Per-channel table of value * (1 - alpha) + color * alpha for every uint8 value, shape (256, 1, 3) as cv2.LUT expects
+    values = np.arange(256, dtype=np.float64)[:, np.newaxis]
+    lut = values * (1 - alpha) + np.asarray(color, dtype=np.float64) * 255 * alpha
+    return np.clip(lut, 0, 255).astype(np.uint8)[:, np.newaxis, :]
+
+def _apply_lut(image, lut):
+    # cv2.LUT works on 2-D multi-channel mats, so fold any batch dimension into the rows
+    return cv2.LUT(image.reshape(-1, *image.shape[-2:]), lut).reshape(image.shape)
+
+def _as_mask(mask, image_ndim):
+    mask = np.asarray(mask)
+    if mask.ndim == image_ndim:
+        mask = mask[..., 0]
+    return mask
+
+
+class TileCanvas:
+    """
+    Preallocated canvas that predicted tiles are written into in place.
+
+    Without blending the tiles are masks and are copied as they are. With blending the
+    tiles are float probabilities, every tile is weighted with a window that fades towards
+    its edges and the weighted mean probability is thresholded once when the canvas is
+    cropped, which hides the seams between overlapping tiles.
+    """
+    def __init__(self, height, width, patch_height, patch_width, blend=False, threshold=0.5):
+        self.blend = blend
+        if blend:
+            self.threshold = threshold
+            self.window = blending_window(patch_height, patch_width)
+            self.probabilities = np.zeros((height, width, 1), dtype=np.float32)
+            self.weights = np.zeros((height, width, 1), dtype=np.float32)
+            self.weighted_tile = np.empty((patch_height, patch_width, 1), dtype=np.float32)
+        else:
+            self.canvas = np.empty((height, width, 1), dtype=np.uint8)
+
+    def add(self, tile, y, x):
+        tile_height, tile_width = tile.shape[:2]
+        if not self.blend:
+            self.canvas[y:y + tile_height, x:x + tile_width] = tile
+            return
+
+        np.multiply(tile, self.window, out=self.weighted_tile)
+        self.probabilities[y:y + tile_height, x:x + tile_width] += self.weighted_tile
+        self.weights[y:y + tile_height, x:x + tile_width] += self.window
+
+    def crop(self, height, width):
+        if not self.blend:
+            return self.canvas[:height, :width]
+        # mean probability > threshold, without dividing by the weights
+        return np.where(self.probabilities[:height, :width] > self.threshold * self.weights[:height, :width], np.uint8(255), np.uint8(0))
+
+@functools.lru_cache(maxsize=None)
+def blending_window(patch_height, patch_width):
+    # Hann window without its zero end points, so that pixels covered by a single tile keep a non-zero weight
+    window_height = np.hanning(patch_height + 2)[1:-1]
+    window_width = np.hanning(patch_width + 2)[1:-1]
+    return np.outer(window_height, window_width).astype(np.float32)[..., np.newaxis]
 
 def close_and_skeletonize(img):
     KERNEL_SIZE = (3,3)
@@ -119,14 +141,57 @@ def calculate_metrics(skeleton_inverted, area_per_pixel):
     
     return num_labels, area, cell_density, std_areas, mean_areas, coefficient_value, num_hexagonal, hexagonal_cell_ratio, feature_counts, three_label_meetings, num_labels, labelled_image
 
-def find_label_meetings(labelled_image, num_labels):
+NEIGHBOUR_OFFSETS = [(-1, -1), (-1, 0), (-1, 1), (0, -1), (0, 1), (1, -1), (1, 0), (1, 1)]
+
+def find_label_meetings(labelled_image, num_labels, legacy=False):
+    """
+    Finds boundary pixels where three or more labels meet.
+
+    Parameters:
+    labelled_image (np.ndarray): 2-D label image where 0 marks cell boundaries.
+    num_labels (int): Number of labels, background excluded.
+    legacy (bool): Use the original per-pixel loop, kept for equivalence testing.
+
+    Returns:
+    tuple: Per-label meeting counts and a list of (x, y) meeting points in row-major order.
+    """
+    if legacy:
+        return _find_label_meetings_loop(labelled_image, num_labels)
+
+    rows, cols = labelled_image.shape
+    num_meetings = np.zeros(num_labels, dtype=int)
+
+    if rows < 3 or cols < 3:
+        return num_meetings, []
+
+    # Interior boundary pixels only, the border row/column has no full neighbourhood
+    ys, xs = np.nonzero(labelled_image[1:-1, 1:-1] == 0)
+    ys += 1
+    xs += 1
+
+    # Stack the 8 shifted views of the label image at every boundary pixel -> (n, 8)
+    neighbours = np.stack([labelled_image[ys + dy, xs + dx] for dy, dx in NEIGHBOUR_OFFSETS], axis=1)
+
+    # After sorting, a label is new whenever it differs from its left neighbour; zeros sort first
+    neighbours.sort(axis=1)
+    is_new_label = np.empty(neighbours.shape, dtype=bool)
+    is_new_label[:, 0] = neighbours[:, 0] != 0
+    is_new_label[:, 1:] = (neighbours[:, 1:] != neighbours[:, :-1]) & (neighbours[:, 1:] != 0)
+
+    is_meeting = np.count_nonzero(is_new_label, axis=1) > 2
+
+    meeting_labels = neighbours[is_meeting][is_new_label[is_meeting]]
+    num_meetings += np.bincount(meeting_labels - 1, minlength=num_labels)[:num_labels]
+
+    meeting_points = list(zip(xs[is_meeting].tolist(), ys[is_meeting].tolist()))
+    return num_meetings, meeting_points
+
+def _find_label_meetings_loop(labelled_image, num_labels):
     rows, cols = labelled_image.shape
     meeting_points = []
 
     num_meetings = np.zeros(num_labels, dtype=int)
 
-    offsets = [(-1, -1), (-1, 0), (-1, 1), (0, -1), (0, 1), (1, -1), (1, 0), (1, 1)]
-
     for i in range(1, rows - 1):
         for j in range(1, cols - 1):
             if labelled_image[i, j] == 0:
@@ -134,7 +199,7 @@ def find_label_meetings(labelled_image, num_labels):
                 unique_labels = set()
 
                 # Check neighbors using precomputed offsets
-                for dy, dx in offsets:
+                for dy, dx in NEIGHBOUR_OFFSETS:
                     neighbor_label = labelled_image[i + dy, j + dx]
                     if neighbor_label != 0:
                         unique_labels.add(neighbor_label)
@@ -150,41 +215,62 @@ def find_label_meetings(labelled_image, num_labels):
 def visualize_labels(original_image, labelled_image, points):
     logger.debug(f"Starting visualize_labels")
     
-    original_image_8bit = np.uint8(255 * original_image)
+    original_image_8bit = original_image if original_image.dtype == np.uint8 else np.uint8(255 * original_image)
     num_labels = np.max(labelled_image) + 1  # Including background
     random_colors = np.random.randint(0, 255, size=(num_labels, 3))
 
-    # Create an empty color image for the labels
-    colored_labels = np.zeros_like(original_image_8bit)
-
-    # Assign random colors to each label
-    for label in range(1, num_labels):  # Skip background
-        colored_labels[labelled_image == label] = random_colors[label]
+    # Colour all labels in a single lookup, background stays black
+    palette = random_colors.astype(np.uint8)
+    palette[0] = 0
+    colored_labels = palette[labelled_image]
 
     # Create a mask for non-zero labels
     mask = labelled_image > 0
 
-    # Initialize an empty image for the overlay
-    overlayed_image = np.zeros_like(original_image_8bit)
-
-    # Alpha factor (transparency)
-    alpha = 0.2
+    # Blend alpha = 0.2 in integer arithmetic, (c + 4 * o) // 5 matches the truncated float blend exactly
+    blended = (colored_labels.astype(np.uint16) + 4 * original_image_8bit.astype(np.uint16)) // 5
 
     # Apply the overlay with transparency only on labeled regions
-    for i in range(3):  # Loop through color channels
-        overlayed_image[:, :, i] = np.where(
-            mask,
-            np.uint8(alpha * colored_labels[:, :, i] + (1 - alpha) * original_image_8bit[:, :, i]),
-            original_image_8bit[:, :, i]
-        )
-        
-    for point in points:
-        cv2.circle(overlayed_image, point, radius=2, color=(0, 255, 0), thickness=-1)  # Green point
+    overlayed_image = np.where(mask[..., np.newaxis], blended.astype(np.uint8), original_image_8bit)
+
+    draw_points(overlayed_image, points, radius=2, color=(0, 255, 0))  # Green points
     return overlayed_image
 
 
-@tf.function
+@functools.lru_cache(maxsize=None)
+def point_stencil(radius):
+    # Rasterise one filled circle with OpenCV so stamped points look exactly like cv2.circle
+    canvas = np.zeros((2 * radius + 1, 2 * radius + 1), dtype=np.uint8)
+    cv2.circle(canvas, (radius, radius), radius=radius, color=1, thickness=-1)
+    dy, dx = np.nonzero(canvas)
+    return dy - radius, dx - radius
+
+
+def draw_points(image, points, radius, color):
+    points = np.asarray(points, dtype=np.intp).reshape(-1, 2)
+    if len(points) == 0:
+        return image
+
+    dy, dx = point_stencil(radius)
+    ys = (points[:, 1, np.newaxis] + dy).ravel()
+    xs = (points[:, 0, np.newaxis] + dx).ravel()
+
+    inside = (ys >= 0) & (ys < image.shape[0]) & (xs >= 0) & (xs < image.shape[1])
+    image[ys[inside], xs[inside]] = color
+    return image
+
+
+@tf.function(input_signature=[
+    tf.TensorSpec(shape=[None, None, None], dtype=tf.uint8),
+    tf.TensorSpec(shape=[], dtype=tf.int32),
+    tf.TensorSpec(shape=[], dtype=tf.int32),
+    tf.TensorSpec(shape=[], dtype=tf.int32),
+    tf.TensorSpec(shape=[], dtype=tf.int32),
+])
 def calculate_padding_and_resize(image, resized_height, resized_width, original_height, original_width):
+    count_trace('calculate_padding_and_resize')
+    original_size = tf.stack([original_height, original_width])
+    
     # Convert all input dimensions to float for consistency in calculations
     resized_height = tf.cast(resized_height, tf.float32)
     resized_width = tf.cast(resized_width, tf.float32)
@@ -216,12 +302,8 @@ def calculate_padding_and_resize(image, resized_height, resized_width, original_
     cropped_image = tf.image.crop_to_bounding_box(image, pad_h_int, pad_w_int, tf.cast(resized_height - 2 * pad_h, tf.int32), tf.cast(resized_width - 2 * pad_w, tf.int32))
 
     # Resize the image back to its original dimensions
-    resized_image = tf.image.resize(cropped_image, [original_height, original_width], method='nearest')
+    resized_image = tf.image.resize(cropped_image, original_size, method='nearest')
 
     logger.debug(f"binarized_image: {resized_image}")
     return resized_image
     
-
-@tf.function
-def remove_dimension(images_dataset):
-    return images_dataset.map(lambda image: tf.squeeze(image, axis=0))
\ No newline at end of file
@@ -1,78 +1,166 @@
 import tensorflow as tf
+from api.analysis.processing.tracing import count_trace
+from api.analysis.processing.performance import DEFAULT_PERFORMANCE_PROFILE
+from api.analysis.processing.decoders import DEFAULT_IMAGE_DECODER
+
+# Input signatures keep the functions below from being retraced for every new image size or patch size
+IMAGE_SPEC = tf.TensorSpec(shape=[None, None, None], dtype=tf.uint8)
+PATCHES_SPEC = tf.TensorSpec(shape=[None, None, None, None], dtype=tf.uint8)
+SCALAR_SPEC = tf.TensorSpec(shape=[], dtype=tf.int32)
+PATCH_SIZE_SPEC = tf.TensorSpec(shape=[3], dtype=tf.int32)
+STRIDES_SPEC = tf.TensorSpec(shape=[2], dtype=tf.int32)
+
+class DecodedImageStore:
+    """
+    Decoded input images of a single task, materialized once and shared by the
+    pipeline and the postprocessing stages.
+
+    Shapes are recorded at decode time so that no stage has to iterate the images
+    again just to find out their dimensions. Decodes are counted by the decoders,
+    see tracing.counting_decodes.
 
-@tf.function
-def load_image(bytes):
-    image = tf.io.decode_image(bytes, channels=3, dtype=tf.float32)
-    return image
-
-@tf.function
-def load_images_dataset(image_bytes_list):
-    # Convert files to a dataset of image contents
-    dataset = tf.data.Dataset.from_tensor_slices(image_bytes_list) # dataset of bytes
-    # Apply processing to each image
-    processed_images = dataset.map(load_image)  # dataset of EagerTensors of shape (None, None, 3)
-    return processed_images
-
-@tf.function
-def pad_dataset(images_dataset, patch_size, **kwargs):
-    # Apply the function to each image and obtain padded images along with original dimensions
-    padded_dataset_with_shapes = images_dataset.map(lambda image: apply_padding_and_return_shape(image, patch_size)) # dataset of tuples of (padded_image, original_shape)
-    # To extract padded images and their original dimensions separately if needed
-    padded_dataset = padded_dataset_with_shapes.map(lambda x, y: x)
-    original_shapes = padded_dataset_with_shapes.map(lambda x, y: y)
-    return padded_dataset, original_shapes
-
-@tf.function
-def apply_padding_and_return_shape(image, patch_size):
+    When decoded for a small target_shape the images may be stored at a reduced
+    resolution, shapes always hold the full resolution and originals() decodes the
+    full resolution images lazily for the overlay and metrics stages.
+
+    A deferred store keeps only the encoded images and decodes each one on first
+    access, holding on to the most recently decoded image only. While an image is
+    used the next decode_ahead images are decoded on the decoder's pool, if it has
+    one. Its shapes are filled in as the images are decoded.
+    """
+    def __init__(self, images, shapes=None):
+        self.images = list(images)
+        self.shapes = list(shapes) if shapes is not None else [tuple(image.shape[:2]) for image in self.images]
+        self.reduction_factors = [1] * len(self.images)
+        self.image_bytes_list = None
+        self.image_decoder = None
+        self.current = None # (index, image) of the last image decoded by a deferred store
+        self.decode_ahead = 0
+        self.pending = {} # index -> function waiting for an image decoded ahead
+
+    @classmethod
+    def decode(cls, image_bytes_list, performance_profile=DEFAULT_PERFORMANCE_PROFILE, image_decoder=DEFAULT_IMAGE_DECODER, target_shape=None):
+        image_bytes_list = list(image_bytes_list)
+        if not image_bytes_list:
+            return cls([])
+
+        if target_shape is None:
+            images = image_decoder.decode_all(image_bytes_list, performance_profile)
+            store = cls(images)
+        else:
+            shapes, factors = image_decoder.plan(image_bytes_list, target_shape)
+            images = image_decoder.decode_all(image_bytes_list, performance_profile, factors)
+            store = cls(images, shapes)
+            store.reduction_factors = factors
+            # The encoded images are kept so that the full resolution originals can be decoded on demand
+            store.image_bytes_list = image_bytes_list
+            store.image_decoder = image_decoder
+        return store
+
+    @classmethod
+    def deferred(cls, image_bytes_list, image_decoder=DEFAULT_IMAGE_DECODER, decode_ahead=1):
+        store = cls([])
+        store.decode_ahead = decode_ahead
+        store.images = None
+        store.shapes = [None] * len(image_bytes_list)
+        store.reduction_factors = [1] * len(image_bytes_list)
+        store.image_bytes_list = image_bytes_list
+        store.image_decoder = image_decoder
+        return store
+
+    def image(self, index):
+        if self.images is not None:
+            return self.images[index]
+        # Consecutive stages ask for the same image, so only a change of index decodes
+        if self.current is None or self.current[0] != index:
+            self.current = None
+            decoded = self.pending.pop(index, None) or self.image_decoder.decode_later(self.image_bytes_list[index])
+            self.pending = {ahead: pending for ahead, pending in self.pending.items() if ahead > index}
+            for ahead in range(index + 1, min(index + 1 + self.decode_ahead, len(self))):
+                if ahead not in self.pending:
+                    self.pending[ahead] = self.image_decoder.decode_later(self.image_bytes_list[ahead])
+            image = decoded()
+            self.shapes[index] = tuple(image.shape[:2])
+            self.current = (index, image)
+        return self.current[1]
+
+    def originals(self):
+        """Yields the full resolution images in input order, decoding the reduced ones one at a time."""
+        for index in range(len(self)):
+            if self.reduction_factors[index] == 1:
+                yield self.image(index)
+            else:
+                yield self.image_decoder.decode(self.image_bytes_list[index])
+
+    def as_dataset(self, indices=None):
+        # Images have different shapes, so they are served from the materialized arrays instead of tensor slices
+        indices = range(len(self)) if indices is None else list(indices)
+        if self.images:
+            ndim, dtype = self.images[0].ndim, tf.as_dtype(self.images[0].dtype)
+        else:
+            ndim, dtype = 3, tf.uint8
+        return tf.data.Dataset.from_generator(lambda: (self.image(index) for index in indices), output_signature=tf.TensorSpec(shape=(None,) * ndim, dtype=dtype))
+
+    def __len__(self):
+        return len(self.reduction_factors)
+
+    def __iter__(self):
+        return (self.image(index) for index in range(len(self)))
+
+    def __getitem__(self, index):
+        return self.image(index)
+
+@tf.function(input_signature=[IMAGE_SPEC, PATCH_SIZE_SPEC, STRIDES_SPEC])
+def apply_padding_and_return_shape(image, patch_size, strides):
+    count_trace('apply_padding_and_return_shape')
     # Record the original dimensions
     original_shape = tf.shape(image)[:2]
 
-    # Calculate padding
-    height_pad = (patch_size[0] - original_shape[0] % patch_size[0]) % patch_size[0]
-    width_pad = (patch_size[1] - original_shape[1] % patch_size[1]) % patch_size[1]
+    # Calculate padding so that patches placed every strides pixels cover the whole image
+    height_pad = tiled_length(original_shape[0], patch_size[0], strides[0]) - original_shape[0]
+    width_pad = tiled_length(original_shape[1], patch_size[1], strides[1]) - original_shape[1]
     padding = [[0, height_pad], [0, width_pad], [0, 0]]
 
     # Apply padding
     padded_image = tf.pad(image, padding, mode='constant', constant_values=0)
     return padded_image, original_shape
 
-@tf.function
-def extract_patches(image, patch_size):
-# Extract patches
-    patches = tf.image.extract_patches(
-        images=tf.expand_dims(image, 0),
-        sizes=[1, *patch_size[:2], 1],
-        strides=[1, *patch_size[:2], 1],
-        rates=[1, 1, 1, 1],
-        padding='VALID'
-    )
-    return tf.reshape(patches, [-1, *patch_size])
-
-@tf.function
-def split_images_into_patches(dataset, patch_size):
-    # Use TensorFlow's built-in functions for efficient mapping
-    dataset = dataset.map(lambda x: extract_patches(x, patch_size))
-
-    patch_counts = dataset.map(lambda x: tf.shape(x)[0])
-    
-    # Flat map the dataset to have each patch as an element
-    dataset = dataset.flat_map(lambda x: tf.data.Dataset.from_tensor_slices(x))
-
-    return dataset, patch_counts
-
-@tf.function
-def get_image_dimensions(image):
-    return tf.shape(image)[:2]
-
-@tf.function
+def tiled_length(length, patch_length, stride):
+    # Smallest length >= the given one (and >= patch_length) that patches placed every stride pixels cover exactly
+    num_patches = (tf.maximum(length - patch_length, 0) + stride - 1) // stride + 1
+    return (num_patches - 1) * stride + patch_length
+
+@tf.function(input_signature=[IMAGE_SPEC, PATCH_SIZE_SPEC, STRIDES_SPEC, tf.TensorSpec(shape=[], dtype=tf.float32)])
+def extract_patches_and_find_background(image, patch_size, strides, min_std):
+    count_trace('extract_patches_and_find_background')
+    patches = extract_patches(image, patch_size, strides)
+    return patches, find_background_patches(patches, min_std)
+
+@tf.function(input_signature=[IMAGE_SPEC, PATCH_SIZE_SPEC, STRIDES_SPEC])
+def extract_patches(image, patch_size, strides):
+    count_trace('extract_patches')
+    # Extract patches, tf.signal.frame accepts tensor sizes where tf.image.extract_patches needs Python constants
+    patches = tf.signal.frame(image, patch_size[0], strides[0], axis=0) # (rows, patch_height, width, channels)
+    patches = tf.signal.frame(patches, patch_size[1], strides[1], axis=2) # (rows, patch_height, columns, patch_width, channels)
+    patches = tf.transpose(patches, [0, 2, 1, 3, 4])
+    return tf.reshape(patches, [-1, patch_size[0], patch_size[1], tf.shape(image)[-1]])
+
+@tf.function(input_signature=[PATCHES_SPEC, tf.TensorSpec(shape=[], dtype=tf.float32)])
+def find_background_patches(patches, min_std):
+    count_trace('find_background_patches')
+    # A nearly uniform patch is background, this covers the zero padding as well as black or saturated borders
+    return tf.math.reduce_std(to_model_input(patches), axis=[1, 2, 3]) < min_std
+
+def to_model_input(images):
+    # uint8 images become float32 in range [0, 1] only at the model boundary
+    return tf.image.convert_image_dtype(images, tf.float32)
+
+@tf.function(input_signature=[IMAGE_SPEC, SCALAR_SPEC, SCALAR_SPEC])
 def resize_with_pad(image, height, width):
-  return tf.clip_by_value(tf.image.resize_with_pad(image, height, width, method='lanczos5'), 0., 1.)
+  count_trace('resize_with_pad')
+  return tf.clip_by_value(tf.image.resize_with_pad(to_model_input(image), height, width, method='lanczos5'), 0., 1.)
 
-@tf.function
-def add_dimension(image):
-    return tf.expand_dims(image, axis=-1)
-
-@tf.function
+@tf.function(input_signature=[IMAGE_SPEC, SCALAR_SPEC])
 def resize_to_next_divisor(image, divisor):
     """
     Resizes an image tensor using tf.image.resize_with_pad so that its dimensions
@@ -85,6 +173,7 @@ def resize_to_next_divisor(image, divisor):
     Returns:
     tf.Tensor: The resized image tensor.
     """
+    count_trace('resize_to_next_divisor')
     # Original dimensions
     original_shape = tf.shape(image)[:2]
 
@@ -93,34 +182,25 @@ def resize_to_next_divisor(image, divisor):
     target_width = ((original_shape[1] - 1) // divisor + 1) * divisor
 
     # Resize with padding
-    resized_image = tf.image.resize_with_pad(image, target_height, target_width)
+    resized_image = tf.image.resize_with_pad(to_model_input(image), target_height, target_width)
 
     return resized_image, original_shape
 
-@tf.function
 def round_up(value, factor):
     """Round up the given value to the nearest multiple of the given factor."""
     return value + (-value % factor)
 
-def round_up_image(image, factor):
+def group_by_shape(shapes):
     """
-    Rounds up an image tensor to the nearest multiple of a given factor.
+    Groups image indices by shape.
 
     Parameters:
-    image (tf.Tensor): A 3-D image tensor of shape [height, width, channels].
-    factor (int): The factor to round up to.
+    shapes (list): Shapes of the images, in input order.
 
     Returns:
-    tf.Tensor: The rounded image tensor.
+    dict: Maps every distinct shape to the indices of the images with that shape, in order of first appearance.
     """
-    # Original dimensions
-    original_shape = tf.shape(image)[:2]
-
-    # Calculate the target dimensions
-    target_height = round_up(original_shape[0], factor)
-    target_width = round_up(original_shape[1], factor)
-
-    # Resize with padding
-    resized_image = tf.image.resize_with_pad(image, target_height, target_width)
-
-    return resized_image, original_shape
\ No newline at end of file
+    groups = {}
+    for index, shape in enumerate(shapes):
+        groups.setdefault(tuple(shape), []).append(index)
+    return groups
@@ -0,0 +1,41 @@
+import collections
+import contextlib
+import contextvars
+import threading
+
+# Number of times each tf.function has been traced in this worker process
+trace_counts = collections.Counter()
+_lock = threading.Lock()
+
+def count_trace(name):
+    # Called at the top of a tf.function body, which only runs while TensorFlow traces the function
+    with _lock:
+        trace_counts[name] += 1
+
+def snapshot():
+    with _lock:
+        return dict(trace_counts)
+
+def traces_since(previous_snapshot):
+    # Traces since the snapshot was taken, concurrent tasks in the same worker are included
+    return {name: count - previous_snapshot.get(name, 0) for name, count in snapshot().items() if count != previous_snapshot.get(name, 0)}
+
+
+# Decode counter of the current task, every greenlet or thread has its own context
+decode_counter = contextvars.ContextVar('decode_counter', default=None)
+
+@contextlib.contextmanager
+def counting_decodes():
+    # Images decoded inside the block are counted in counter['images']
+    counter = collections.Counter()
+    token = decode_counter.set(counter)
+    try:
+        yield counter
+    finally:
+        decode_counter.reset(token)
+
+def count_decodes(count=1):
+    # Called by the decoders in the thread that requested the decode, decodes outside counting_decodes are not counted
+    counter = decode_counter.get()
+    if counter is not None:
+        counter['images'] += count
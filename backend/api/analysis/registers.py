@@ -1,10 +1,16 @@
 from api.analysis.model_wrappers.tensorflow_model_wrapper import TensorFlowModelWrapper
+from api.analysis.model_wrappers.tflite_model_wrapper import TFLiteModelWrapper
 from api.analysis.pipelines.tiling_pipeline import TilingPipeline
 from api.analysis.pipelines.resize_with_pad_pipeline import ResizeWithPadPipeline
 from api.analysis.pipelines.dynamic_resize_with_pad_pipeline import DynamicResizeWithPadPipeline
 from api.analysis.pipelines.variable_shape_pipeline import VariableShapePipeline
 from api.analysis.model_wrappers.binarization_wrapper import BinarizationWrapper
-from api.analysis.model_wrappers.ragged_binarization_wrapper import RaggedBinarizationWrapper
+from api.analysis.processing.performance import PerformanceProfile
+from api.analysis.processing.decoders import TensorFlowImageDecoder, OpenCVImageDecoder
+from api.analysis.lazy_registry import LazyModelRegistry, LazyPipelineRegistry
+from api.analysis.manifest import pipeline_manifest
+from django.conf import settings
+import os
 
 model_paths = {
     'custom': 'api/analysis/models/custom',
@@ -12,30 +18,47 @@ model_paths = {
     'sm_unet-variable': 'api/analysis/models/cea_sm_unet_variable.keras',
 }
 
-models = {
-    'custom': BinarizationWrapper(TensorFlowModelWrapper(model_paths['custom']).load_model(), threshold=0.1),
-    'sm_unet-fixed': BinarizationWrapper(TensorFlowModelWrapper(model_paths['sm_unet-fixed']).load_model(), threshold=0.15),
-    'sm_unet-variable': BinarizationWrapper(TensorFlowModelWrapper(model_paths['sm_unet-variable']).load_model(), threshold=0.15),
-    'sm-unet-variable-ragged': RaggedBinarizationWrapper(TensorFlowModelWrapper(model_paths['sm_unet-variable']).load_model(), threshold=0.15),
+# Backends load the model files, they are shared by all models that point at the same file
+model_backends = {
+    'custom': lambda: TensorFlowModelWrapper(model_paths['custom']),
+    'sm_unet-fixed': lambda: TensorFlowModelWrapper(model_paths['sm_unet-fixed']),
+    'sm_unet-variable': lambda: TensorFlowModelWrapper(model_paths['sm_unet-variable']),
+    # converted and dynamic range quantized on first load, the .tflite file is cached next to the model
+    'sm_unet-variable-tflite': lambda: TFLiteModelWrapper(model_paths['sm_unet-variable'], quantization='dynamic_range'),
 }
 
-pipelines_registry = {
-    'custom-resize_with_pad 128x128': ResizeWithPadPipeline(models['custom'], target_dimensions=(128, 128)),
-    'custom-tiling 128x128': TilingPipeline(models['custom'], patch_size=(128, 128, 3)),
-    
-    'sm_unet-resize_with_pad 512x512': ResizeWithPadPipeline(models['sm_unet-fixed'], target_dimensions=(512, 512)),
-    'sm_unet-tiling 512x512': TilingPipeline(models['sm_unet-fixed'], patch_size=(512, 512, 3)),
-
-    'sm_unet-variable-resize_with_pad 1024x1024': ResizeWithPadPipeline(models['sm_unet-variable'], target_dimensions=(1024, 1024)),
-    'sm_unet-variable-resize_with_pad 512x512': ResizeWithPadPipeline(models['sm_unet-variable'], target_dimensions=(512, 512)),
-    'sm_unet-variable-resize_with_pad 128x128': ResizeWithPadPipeline(models['sm_unet-variable'], target_dimensions=(128, 128)),
-    'sm_unet-variable-dynamic_resize_with_pad': DynamicResizeWithPadPipeline(models['sm_unet-variable'], downsampling_factor=64),
-    'sm_unet-variable-variable': VariableShapePipeline(models['sm-unet-variable-ragged'], downsampling_factor=64),
-    'sm_unet-variable-tiling 128x128': TilingPipeline(models['sm_unet-variable'], patch_size=(128, 128, 3)),
-    'sm_unet-variable-tiling 512x512': TilingPipeline(models['sm_unet-variable'], patch_size=(512, 512, 3)),
-    'sm_unet-variable-tiling 1024x1024': TilingPipeline(models['sm_unet-variable'], patch_size=(1024, 1024, 3)),
+models = LazyModelRegistry(model_backends, {
+    'custom': ('custom', lambda backend: BinarizationWrapper(backend, threshold=0.1)),
+    'sm_unet-fixed': ('sm_unet-fixed', lambda backend: BinarizationWrapper(backend, threshold=0.15)),
+    'sm_unet-variable': ('sm_unet-variable', lambda backend: BinarizationWrapper(backend, threshold=0.15)),
+    'sm_unet-variable-tflite': ('sm_unet-variable-tflite', lambda backend: BinarizationWrapper(backend, threshold=0.15)),
+}, memory_budget=settings.MODEL_MEMORY_BUDGET_MB * 2**20)
+
+# Only pipelines that build tf.data datasets take a profile, tiling predicts the patches of one image directly
+performance_profiles = {
+    # decode out of order and run tf.data on its own threads, for pipelines with heavy resizing
+    'parallel': PerformanceProfile('parallel', deterministic=False, private_threadpool_size=os.cpu_count() or 1),
+}
+
+image_decoders = {
+    'tensorflow': TensorFlowImageDecoder(),
+    # cv2.imdecode on a thread pool, the tiling pipelines decode the next image on it while the model predicts the current one
+    'opencv': OpenCVImageDecoder(max_workers=os.cpu_count() or 1),
 }
 
+pipeline_types = {
+    'resize_with_pad': lambda model, entry: ResizeWithPadPipeline(model, target_dimensions=entry['target_dimensions'], performance_profile=performance_profiles['parallel']),
+    'dynamic_resize_with_pad': lambda model, entry: DynamicResizeWithPadPipeline(model, downsampling_factor=entry['downsampling_factor'], performance_profile=performance_profiles['parallel']),
+    'variable_shape': lambda model, entry: VariableShapePipeline(model, downsampling_factor=entry['downsampling_factor'], performance_profile=performance_profiles['parallel']),
+    'tiling': lambda model, entry: TilingPipeline(model, patch_size=entry['patch_size'], overlap=entry.get('overlap', 0), image_decoder=image_decoders['opencv']),
+}
+
+def pipeline_creator(entry):
+    return lambda model: pipeline_types[entry['type']](model, entry)
+
+# Pipelines are created on first use from the manifest, listing the names does not load any model
+pipelines_registry = LazyPipelineRegistry(models, {name: (entry['model'], pipeline_creator(entry)) for name, entry in pipeline_manifest.items()})
+
 available_pipelines = {
     "Tiling": TilingPipeline,
     "Resizing with padding": ResizeWithPadPipeline,
@@ -1,17 +1,37 @@
 import boto3
+from concurrent.futures import ThreadPoolExecutor
 from botocore.exceptions import ClientError
+from botocore.config import Config
 import logging
 
 logger = logging.getLogger(__name__)
 
 class MinioRepository:
-    def __init__(self, endpoint_url, access_key, secret_key, bucket_name):
+    DEFAULT_MAX_WORKERS = 8
+    # Concurrent uploads and downloads each need a connection, the botocore default of 10 would make them wait
+    DEFAULT_MAX_POOL_CONNECTIONS = 32
+    # delete_objects accepts at most 1000 keys per request
+    MAX_DELETE_KEYS = 1000
+
+    DEFAULT_PRESIGNED_EXPIRATION = 3600
+
+    def __init__(self, endpoint_url, access_key, secret_key, bucket_name, max_pool_connections=DEFAULT_MAX_POOL_CONNECTIONS, public_endpoint_url=None):
         self.s3_client = boto3.client(
             service_name='s3',
             endpoint_url=endpoint_url,
             aws_access_key_id=access_key,
             aws_secret_access_key=secret_key,
-            region_name='us-east-1'  # Change if needed
+            region_name='us-east-1',  # Change if needed
+            config=Config(max_pool_connections=max_pool_connections, tcp_keepalive=True)
+        )
+        # The host is part of the signature, so URLs handed to clients are signed for the endpoint they can reach
+        self.presign_client = boto3.client(
+            service_name='s3',
+            endpoint_url=public_endpoint_url if public_endpoint_url else endpoint_url,
+            aws_access_key_id=access_key,
+            aws_secret_access_key=secret_key,
+            region_name='us-east-1',
+            config=Config(signature_version='s3v4', s3={'addressing_style': 'path'})
         )
         self.bucket_name = bucket_name
         self._create_bucket_if_not_exists()
@@ -43,33 +63,66 @@ class MinioRepository:
             logger.error(f"Failed to upload file: {e}")
             return None
 
+    def upload_files_directly(self, uploaded_files, object_names, max_workers=DEFAULT_MAX_WORKERS):
+        # boto3 clients are thread safe, the uploads run concurrently and the results keep the input order
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return list(executor.map(self.upload_file_directly, uploaded_files, object_names))
+
+    def download_bytes(self, object_name):
+        response = self.s3_client.get_object(Bucket=self.bucket_name, Key=object_name)
+        return response['Body'].read()
+
     def download_file(self, object_name, file_path):
         try:
             self.s3_client.download_file(self.bucket_name, object_name, file_path)
         except ClientError as e:
             logger.error(f"Failed to download file: {e}")
 
+    def file_exists(self, object_name):
+        try:
+            self.s3_client.head_object(Bucket=self.bucket_name, Key=object_name)
+            return True
+        except ClientError:
+            return False
+
     def delete_file(self, object_name):
         self.s3_client.delete_object(Bucket=self.bucket_name, Key=object_name)
         
         
     def delete_files(self, object_names):
-        # Create a list of objects to delete
-        objects_to_delete = [{'Key': object_name} for object_name in object_names]
+        object_names = list(object_names)
+        for start in range(0, len(object_names), self.MAX_DELETE_KEYS):
+            # Create a list of objects to delete
+            objects_to_delete = [{'Key': object_name} for object_name in object_names[start:start + self.MAX_DELETE_KEYS]]
 
-        # Delete all objects in a single request
-        response = self.s3_client.delete_objects(
-            Bucket=self.bucket_name,
-            Delete={
-                'Objects': objects_to_delete,
-                'Quiet': True  # Set to False if you want a response for each object deletion
-            }
-        )
+            # Delete up to 1000 objects in a single request
+            response = self.s3_client.delete_objects(
+                Bucket=self.bucket_name,
+                Delete={
+                    'Objects': objects_to_delete,
+                    'Quiet': True  # Set to False if you want a response for each object deletion
+                }
+            )
+            for error in response.get('Errors', []):
+                logger.error(f"Failed to delete {error['Key']}: {error['Message']}")
+
+    def presigned_url(self, object_name, expires_in=DEFAULT_PRESIGNED_EXPIRATION, download_name=None):
+        # Signing happens locally, no request is sent to the object store
+        params = {'Bucket': self.bucket_name, 'Key': object_name}
+        if download_name:
+            params['ResponseContentDisposition'] = f'attachment; filename="{download_name}"'
+        return self.presign_client.generate_presigned_url('get_object', Params=params, ExpiresIn=expires_in)
+
+    def iterate_files(self, prefix=''):
+        # Only the keys under prefix are listed, page by page, so the cost does not depend on the rest of the bucket
+        paginator = self.s3_client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket_name, Prefix=prefix):
+            for item in page.get("Contents", []):
+                yield item
 
-    def list_files(self):
+    def list_files(self, prefix=''):
         try:
-            response = self.s3_client.list_objects_v2(Bucket=self.bucket_name)
-            return [item["Key"] for item in response.get("Contents", [])]
+            return [item["Key"] for item in self.iterate_files(prefix)]
         except ClientError as e:
             logger.error(f"Failed to list files: {e}")
             return []
@@ -1,5 +1,6 @@
 from rest_framework import serializers
-from api.analysis.registers import pipelines_registry, available_pipelines
+import os
+from api.analysis.manifest import pipeline_manifest, custom_pipeline_types, CUSTOM_MODEL_ID_PATTERN
 
 class NullableFileField(serializers.FileField):
     def to_internal_value(self, data):
@@ -7,6 +8,14 @@ class NullableFileField(serializers.FileField):
             return None
         return super().to_internal_value(data)
 
+class CustomModelSerializer(serializers.Serializer):
+    custom_model = serializers.FileField()
+
+    def validate_custom_model(self, value):
+        if os.path.splitext(value.name)[1].lower() not in ('.keras', '.h5', '.zip'):
+            raise serializers.ValidationError("Custom model must be a .keras, .h5 or zipped SavedModel file")
+        return value
+
 # Define a serializer
 class AnalysisRequestSerializer(serializers.Serializer):
     input_images = serializers.ListField(
@@ -33,6 +42,7 @@ class AnalysisRequestSerializer(serializers.Serializer):
     
     pipeline = serializers.CharField(required=False)
     custom_model = serializers.FileField(required=False)
+    custom_model_id = serializers.RegexField(CUSTOM_MODEL_ID_PATTERN, required=False)
     custom_model_pipeline = serializers.CharField(required=False)
     
     threshold = serializers.FloatField(required=False, min_value=0, max_value=1)
@@ -63,6 +73,7 @@ class AnalysisRequestSerializer(serializers.Serializer):
     def validate(self, data):
         pipeline = data.get('pipeline')
         custom_model = data.get('custom_model')
+        custom_model_id = data.get('custom_model_id')
         custom_model_pipeline = data.get('custom_model_pipeline')
         target_height = data.get('target_height')
         target_width = data.get('target_width')
@@ -75,26 +86,29 @@ class AnalysisRequestSerializer(serializers.Serializer):
             raise serializers.ValidationError({"labelled_output_path": "Output path for labelled images must be provided when generating labelled images"})
         
         if pipeline:
-            if custom_model:
+            if custom_model or custom_model_id:
                 raise serializers.ValidationError({"custom_model": "Cannot upload model when also pipeline is selected"})
             
-            if pipeline not in pipelines_registry:
+            if pipeline not in pipeline_manifest:
                 raise serializers.ValidationError({"pipeline": "Invalid pipeline"})
         else:
-            if not custom_model:
+            if not custom_model and not custom_model_id:
                 raise serializers.ValidationError({"pipeline": "No model uploaded"})
 
+            if custom_model and custom_model_id:
+                raise serializers.ValidationError({"custom_model_id": "Cannot upload model when also a registered model is selected"})
+
             if not custom_model_pipeline:
                 raise serializers.ValidationError({"pipeline": "No custom model pipeline selected"})
             
-            if not custom_model_pipeline in available_pipelines:
+            if not custom_model_pipeline in custom_pipeline_types:
                 raise serializers.ValidationError({"custom_model_pipeline": "Invalid custom model pipeline"})
             
-            if available_pipelines[custom_model_pipeline] == 'Resizing with padding' or available_pipelines[custom_model_pipeline] == 'Tiling':
+            if custom_pipeline_types[custom_model_pipeline] in ('resize_with_pad', 'tiling'):
                 if not target_height or not target_width:
                     raise serializers.ValidationError({"target_height": "Target height and width must be provided"})
             
-            elif available_pipelines[custom_model_pipeline] == 'Dynamic resizing with padding':
+            elif custom_pipeline_types[custom_model_pipeline] == 'dynamic_resize_with_pad':
                 if not downsampling_factor:
                     raise serializers.ValidationError({"downsampling_factor": "Downsampling factor must be provided"})
             if not threshold:
@@ -7,15 +7,18 @@ import tensorflow as tf
 import numpy as np
 from api.analysis.processing.postprocessing import calculate_metrics, close_and_skeletonize, overlay_masks, visualize_labels
 from api.utils.path_utils import generate_output_path
+import api.analysis.processing.tracing as tracing
 from api.analysis.services.abstract_service import AbstractService
+from api.analysis.services.result_uploader import ResultUploader
+from api.analysis.services.prefetched_objects import PrefetchedObjects
 import cv2
-import base64
 from api.analysis.repositories.minio_repository import MinioRepository
 import zipfile
 import tempfile
 from api.analysis.model_wrappers.binarization_wrapper import BinarizationWrapper
-from api.analysis.model_wrappers.ragged_binarization_wrapper import RaggedBinarizationWrapper
 from api.analysis.registers import pipelines_registry, available_pipelines
+from api.analysis.lazy_registry import LoadedModelCache
+from django.conf import settings
 import os
 import glob
 
@@ -29,6 +32,9 @@ minio_repo = MinioRepository(
     bucket_name='corneal-endothelium-analeyezer'
 )
 
+# Registered custom models by content hash, kept loaded across tasks
+custom_model_cache = LoadedModelCache(settings.CUSTOM_MODEL_CACHE_SIZE)
+
 def model_wrapper_factory(model_path, model_type):
     if model_type == "tensorflow":
         return TensorFlowModelWrapper(model_path).load_model()
@@ -50,16 +56,51 @@ def pipeline_factory(pipeline_type, model_wrapper, target_dimensions=None, downs
         raise ValueError("Unsupported pipeline type")
     
 
+def load_custom_model(object_name, extension):
+    with tempfile.NamedTemporaryFile(suffix=extension) as tmp_file:
+        logger.debug(f"Downloading model to {tmp_file.name}...")
+        minio_repo.download_file(object_name, tmp_file.name)
+        
+        if extension != '.zip':
+            return model_wrapper_factory(tmp_file.name, 'tensorflow')
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            
+            logger.debug(f"Unzipping model to {tmp_dir}")
+            with zipfile.ZipFile(tmp_file.name, 'r') as zip_ref:
+                zip_ref.extractall(tmp_dir)
+
+            logger.debug(f"listing files...")
+
+            # Use glob to find saved_model.pb
+            model_files = glob.glob(f"{tmp_dir}/**/saved_model.pb", recursive=True)
+
+            if not model_files:
+                # Handle the case where saved_model.pb is not found
+                logger.error("saved_model.pb not found in the unzipped files")
+                raise ValueError("saved_model.pb not found in the zip file")
+
+            # Assuming the first match is the desired one
+            model_dir = os.path.dirname(model_files[0])
+            return model_wrapper_factory(model_dir, 'tensorflow')
+
 class AnalysisService(AbstractService):
     def zip_encode(img, base_file_path, relative_file_path):
         result, buffer = cv2.imencode('.png', img)
         if result == False:
             raise Exception("could not encode image!")
         
-        return (base64.b64encode(buffer).decode('utf-8'), str(generate_output_path(base_file_path, relative_file_path)))
+        return (buffer.tobytes(), str(generate_output_path(base_file_path, relative_file_path)))
     
     @staticmethod
-    def process(task_id, input_images, input_images_paths, input_masks, predictions_path, overlayed_path, area_per_pixel, generate_labelled_images, labelled_images_path, pipeline_name, custom_model_object_name, custom_model_extension, pipeline_type, target_dimensions, downsampling_factor, threshold):
+    def delete_inputs(input_image_keys, input_mask_keys):
+        keys = [key for key in list(input_image_keys) + list(input_mask_keys) if key]
+        if keys:
+            logger.debug(f"Deleting {len(keys)} input files...")
+            minio_repo.delete_files(keys)
+    
+    @staticmethod
+    def process(task_id, input_images, input_images_paths, input_masks, predictions_path, overlayed_path, area_per_pixel, generate_labelled_images, labelled_images_path, pipeline_name, custom_model_object_name, custom_model_extension, pipeline_type, target_dimensions, downsampling_factor, threshold, custom_model_id=None):
         logger.debug(f'AnalysisService started images with task_id {task_id}')
         
         if pipeline_name:
@@ -69,110 +110,87 @@ class AnalysisService(AbstractService):
             logger.debug(f'Custom model object name: {custom_model_object_name}')
             logger.debug(f'Custom model extension: {custom_model_extension}')
             try:
-                with tempfile.NamedTemporaryFile(suffix=custom_model_extension) as tmp_file:
-                    logger.debug(f"Downloading model to {tmp_file.name}...")
-                    minio_repo.download_file(custom_model_object_name, tmp_file.name)
-                    
-                    if custom_model_extension == '.zip':
-                        with tempfile.TemporaryDirectory() as tmp_dir:
-                            
-                            logger.debug(f"Unzipping model to {tmp_dir}")
-                            with zipfile.ZipFile(tmp_file.name, 'r') as zip_ref:
-                                zip_ref.extractall(tmp_dir)
-
-                            logger.debug(f"listing files...")
-
-                            # Use glob to find saved_model.pb
-                            model_files = glob.glob(f"{tmp_dir}/**/saved_model.pb", recursive=True)
-
-                            if model_files:
-                                # Assuming the first match is the desired one
-                                model_dir = os.path.dirname(model_files[0])
-                            else:
-                                # Handle the case where saved_model.pb is not found
-                                logger.error("saved_model.pb not found in the unzipped files")
-                                return (None, None), "saved_model.pb not found in the zip file"
-
-                            logger.debug(f"Creating {pipeline_type}")
-                            model = model_wrapper_factory(model_dir, 'tensorflow')
-                    else:
-                        logger.debug(f"Creating {pipeline_type}")
-                        model = model_wrapper_factory(tmp_file.name, 'tensorflow')
-                    binarized_model = BinarizationWrapper(model, threshold=threshold)
-                    pipeline = pipeline_factory(pipeline_type, binarized_model, target_dimensions=target_dimensions, downsampling_factor=downsampling_factor)
-                    logger.info(f"Loaded model input shape: {pipeline.model.model.model.input_shape}")
-                    logger.info(f"Loaded model output shape: {pipeline.model.model.model.output_shape}")
+                if custom_model_id:
+                    # Registered models are kept in the repository and loaded once per worker
+                    model = custom_model_cache.get_or_load(custom_model_id, lambda: load_custom_model(custom_model_object_name, custom_model_extension))
+                else:
+                    model = load_custom_model(custom_model_object_name, custom_model_extension)
+                logger.debug(f"Creating {pipeline_type}")
+                binarized_model = BinarizationWrapper(model, threshold=threshold)
+                pipeline = pipeline_factory(pipeline_type, binarized_model, target_dimensions=target_dimensions, downsampling_factor=downsampling_factor)
+                logger.info(f"Loaded model input shape: {pipeline.model.model.model.input_shape}")
+                logger.info(f"Loaded model output shape: {pipeline.model.model.model.output_shape}")
             except Exception as e:
                 logger.error(f"Error downloading model: {str(e)}")
-                return (None, None), str(e)
+                return (None, None, None), str(e)
             finally:
-                logger.debug(f"Deleting model file: custom_model_object_name")
-                minio_repo.delete_file(custom_model_object_name)
+                if not custom_model_id:
+                    logger.debug(f"Deleting model file: {custom_model_object_name}")
+                    minio_repo.delete_file(custom_model_object_name)
                 
                 
-        logger.debug('Starting pipeline...')
-        predictions, original_images = pipeline.process(input_images)
-        logger.debug('Pipeline finished')
+        # Inputs are fetched as the pipeline reads them, a few images ahead, instead of all of them up front
+        logger.debug(f'Fetching {len(input_images)} input images...')
+        input_images = PrefetchedObjects(minio_repo, input_images)
+        input_masks = PrefetchedObjects(minio_repo, input_masks)
         
-        processed_data = []
+        logger.debug('Starting pipeline...')
+        pipeline_stats = {}
+        traces_before = tracing.snapshot()
         metrics = []
+        uploaded_files = []
         
-        for original_image, reference, prediction, file_path in zip(original_images, input_masks, predictions, input_images_paths):
-            logger.debug(f"Overlaying mask...")
-            overlayed_image = overlay_masks(original_image, tf.io.decode_image(reference, channels=1, dtype=tf.float32) if reference else tf.zeros([original_image.shape[0], original_image.shape[1], original_image.shape[2]]), prediction)
+        # Streaming pipelines decode while the predictions are consumed, so the whole loop counts decodes
+        with tracing.counting_decodes() as decodes, input_images, input_masks, ResultUploader(minio_repo) as uploader:
+            predictions, original_images = pipeline.process_stream(input_images, stats=pipeline_stats)
+            logger.debug(f'Pipeline started, decoded {decodes["images"]} images')
             
-            logger.debug(f"Casting overlayed image...")
-            overlayed_image = tf.cast((overlayed_image * 255), tf.uint8).numpy()
-            prediction = prediction.numpy()
+            def upload(image, file_path, relative_file_path):
+                # Every result is uploaded as soon as it is encoded, the index keeps the files in order
+                data, filename = AnalysisService.zip_encode(image, file_path, relative_file_path)
+                uploader.submit(data, f"{task_id}\\{len(uploader.futures):03d}\\{filename}")
             
-            logger.debug(f"Closing and skeletonizing prediction...")
-            prediction = close_and_skeletonize(prediction)
-            
-            logger.debug(f"Encoding prediction...")
-            processed_data.append(AnalysisService.zip_encode((prediction * 255).astype(np.uint8), file_path, predictions_path))
-            
-            logger.debug(f"Encoding overlayed image...")
-            processed_data.append(AnalysisService.zip_encode(cv2.cvtColor(overlayed_image, cv2.COLOR_BGR2RGB), file_path, overlayed_path))
-            
-            logger.debug(f"Generated overlay path {str(generate_output_path(file_path, overlayed_path))}")
-            
-            logger.debug(f"Calculating metrics for {file_path}")
-            skeleton_inverted = np.invert(prediction).astype(np.uint8)
-            num_labels, area, cell_density, std_areas, mean_areas, coefficient_value, num_hexagonal, hexagonal_cell_ratio, feature_counts, three_label_meetings, num_labels, labelled_image = calculate_metrics(skeleton_inverted, area_per_pixel)
+            for original_image, reference, prediction, file_path in zip(original_images.originals(), input_masks, predictions, input_images_paths):
+                prediction = np.asarray(prediction)
+                
+                logger.debug(f"Overlaying mask...")
+                reference_mask = tf.io.decode_image(reference, channels=1).numpy() if reference else None
+                overlayed_image = overlay_masks(original_image, reference_mask, prediction)
+                
+                logger.debug(f"Closing and skeletonizing prediction...")
+                prediction = close_and_skeletonize(prediction)
+                
+                logger.debug(f"Encoding prediction...")
+                upload((prediction * 255).astype(np.uint8), file_path, predictions_path)
+                
+                logger.debug(f"Encoding overlayed image...")
+                upload(cv2.cvtColor(overlayed_image, cv2.COLOR_BGR2RGB), file_path, overlayed_path)
+                
+                logger.debug(f"Generated overlay path {str(generate_output_path(file_path, overlayed_path))}")
+                
+                logger.debug(f"Calculating metrics for {file_path}")
+                skeleton_inverted = np.invert(prediction).astype(np.uint8)
+                num_labels, area, cell_density, std_areas, mean_areas, coefficient_value, num_hexagonal, hexagonal_cell_ratio, feature_counts, three_label_meetings, num_labels, labelled_image = calculate_metrics(skeleton_inverted, area_per_pixel)
 
-            logger.debug(f"Appending metrics...")
-            metrics.append((num_labels, area, cell_density, std_areas, mean_areas, coefficient_value, num_hexagonal, hexagonal_cell_ratio))
-            
-            if generate_labelled_images:
-                logger.debug(f"Generating labelled image...")
-                labels_visualization_image = visualize_labels(original_image, labelled_image, three_label_meetings)
+                logger.debug(f"Appending metrics...")
+                metrics.append((num_labels, area, cell_density, std_areas, mean_areas, coefficient_value, num_hexagonal, hexagonal_cell_ratio))
                 
-                logger.debug(f"Encoding labelled image...")
-                processed_data.append(AnalysisService.zip_encode(labels_visualization_image, file_path, labelled_images_path))
+                if generate_labelled_images:
+                    logger.debug(f"Generating labelled image...")
+                    labels_visualization_image = visualize_labels(original_image, labelled_image, three_label_meetings)
+                    
+                    logger.debug(f"Encoding labelled image...")
+                    upload(labels_visualization_image, file_path, labelled_images_path)
             
+            logger.debug(f'Waiting for {len(uploader.futures)} uploads...')
+            uploaded_files = uploader.finish()
+            
+        pipeline_stats['decode_count'] = decodes['images']
+        pipeline_stats['tf_function_traces'] = tracing.traces_since(traces_before)
+        pipeline_stats['performance_profile'] = pipeline.performance_profile.as_dict() if pipeline.performance_profile else None
+        pipeline_stats['image_decoder'] = pipeline.image_decoder.name
+        pipeline_stats['uploaded_files'] = len(uploaded_files)
         logger.debug(f'Metrics: {metrics}')
+        logger.debug(f'Pipeline stats: {pipeline_stats}')
         
-        max_retries = 5
-        for retry in range(max_retries):
-            for index, (data, filename) in enumerate(processed_data):
-                #logger.debug(f'generating ordered filename...')
-                ordered_filename = f"{task_id}\{index:03d}\{filename}"
-                
-                #logger.debug(f'decoding data...')
-                image_data_bytes = base64.b64decode(data.encode('utf-8'))
-                
-                #logger.debug(f'uploading file...')
-                minio_repo.upload_file_directly(image_data_bytes, ordered_filename)
-
-            logger.debug(f'listing files...')
-            files = minio_repo.list_files()
-            task_files = [f for f in files if f.startswith(f"{task_id}\\")]
-
-            if len(task_files) == len(processed_data):
-                logger.debug(f"upload successful after {retry} retries")
-                return (None, metrics), None
-            else:
-                logger.debug(f"retrying upload after {retry} retries")
-
-        logger.debug(f"upload failed after {max_retries} retries, returning processed data via message broker")
-        return (processed_data, metrics), None
\ No newline at end of file
+        return (None, metrics, pipeline_stats), None
\ No newline at end of file
@@ -0,0 +1,58 @@
+from collections.abc import Sequence
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+class PrefetchedObjects(Sequence):
+    """
+    Contents of repository objects, downloaded when they are accessed.
+
+    Accessing an object starts downloading the next prefetch objects in the background, so
+    reading the objects in order rarely waits. Contents are handed out once and not kept,
+    reading an object again downloads it again, so reading in order holds at most prefetch + 1
+    objects in memory. Object names that are None read as None.
+    """
+    DEFAULT_PREFETCH = 8
+
+    def __init__(self, repository, object_names, prefetch=DEFAULT_PREFETCH):
+        if prefetch < 0:
+            raise ValueError("prefetch must be a non-negative integer")
+        self.repository = repository
+        self.object_names = list(object_names)
+        self.prefetch = prefetch
+        self.executor = ThreadPoolExecutor(max_workers=max(prefetch, 1))
+        self.futures = {}
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        with self.lock:
+            for future in self.futures.values():
+                future.cancel()
+            self.futures.clear()
+        self.executor.shutdown(wait=False)
+
+    def __len__(self):
+        return len(self.object_names)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("object index out of range")
+
+        with self.lock:
+            # Objects before index were skipped or already handed out
+            for skipped in [i for i in self.futures if i < index]:
+                self.futures.pop(skipped).cancel()
+            for ahead in range(index, min(index + self.prefetch + 1, len(self))):
+                if ahead not in self.futures and self.object_names[ahead]:
+                    self.futures[ahead] = self.executor.submit(self.repository.download_bytes, self.object_names[ahead])
+            future = self.futures.pop(index, None)
+        return future.result() if future else None
@@ -0,0 +1,59 @@
+from concurrent.futures import ThreadPoolExecutor, wait
+import threading
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+class ResultUploader:
+    """
+    Uploads result files to the repository in the background while the next images are processed.
+
+    At most max_pending encoded files wait in memory, submit blocks until one of them is
+    uploaded, so the memory of a task does not grow with the number of images. Every file
+    is retried on its own, up to max_retries times.
+    """
+    DEFAULT_MAX_WORKERS = 4
+    DEFAULT_MAX_PENDING = 16
+    DEFAULT_MAX_RETRIES = 5
+
+    def __init__(self, repository, max_workers=DEFAULT_MAX_WORKERS, max_pending=DEFAULT_MAX_PENDING, max_retries=DEFAULT_MAX_RETRIES, retry_delay=0.5):
+        self.repository = repository
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.pending = threading.BoundedSemaphore(max_pending)
+        self.futures = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.executor.shutdown(wait=True)
+
+    def submit(self, data, object_name):
+        self.pending.acquire()
+        future = self.executor.submit(self.upload, data, object_name)
+        future.add_done_callback(lambda _: self.pending.release())
+        self.futures.append(future)
+
+    def upload(self, data, object_name):
+        for retry in range(self.max_retries):
+            try:
+                if self.repository.upload_file_directly(data, object_name) is not None:
+                    return object_name
+            except Exception as e:
+                logger.error(f"Failed to upload {object_name}: {str(e)}")
+            if retry == self.max_retries - 1:
+                break
+            logger.debug(f"retrying upload of {object_name} after {retry + 1} failed attempts")
+            time.sleep(self.retry_delay * 2 ** retry)
+        raise IOError(f"upload of {object_name} failed after {self.max_retries} attempts")
+
+    def finish(self):
+        """Waits for all uploads and returns the names of the uploaded files, raises if any of them failed."""
+        wait(self.futures)
+        failed = [future.exception() for future in self.futures if future.exception()]
+        if failed:
+            raise IOError(f"{len(failed)} of {len(self.futures)} uploads failed: {failed[0]}")
+        return [future.result() for future in self.futures]
@@ -0,0 +1,48 @@
+from datetime import datetime, timedelta, timezone
+from collections import defaultdict
+import logging
+from api.analysis.manifest import CUSTOM_MODELS_PREFIX, INPUTS_PREFIX
+
+logger = logging.getLogger(__name__)
+
+def retention_prefix(object_name):
+    """
+    Prefix an object expires with, task results under task_id\\ and request inputs under inputs/uuid/.
+    Registered custom models and unknown objects never expire.
+    """
+    if object_name.startswith(CUSTOM_MODELS_PREFIX):
+        return None
+    if object_name.startswith(INPUTS_PREFIX):
+        return INPUTS_PREFIX + object_name[len(INPUTS_PREFIX):].split('/', 1)[0] + '/'
+    if '\\' in object_name:
+        return object_name.split('\\', 1)[0] + '\\'
+    return None
+
+def expired_objects(objects, ttl, now=None):
+    """
+    Parameters:
+    objects: listed objects with Key and LastModified
+    ttl: timedelta results are kept for after their last object was written
+    now: current time, defaults to the current UTC time
+
+    Returns:
+    dictionary of expired prefix to the names of its objects
+    """
+    now = now if now else datetime.now(timezone.utc)
+    prefixes = defaultdict(list)
+    last_modified = {}
+    for item in objects:
+        prefix = retention_prefix(item['Key'])
+        if prefix is None:
+            continue
+        prefixes[prefix].append(item['Key'])
+        last_modified[prefix] = max(last_modified.get(prefix, item['LastModified']), item['LastModified'])
+    return {prefix: object_names for prefix, object_names in prefixes.items() if now - last_modified[prefix] > ttl}
+
+def delete_expired(repository, ttl_seconds):
+    # One pass over the bucket, the expired objects of all prefixes are deleted together in batches of 1000 keys
+    expired = expired_objects(repository.iterate_files(), timedelta(seconds=ttl_seconds))
+    object_names = [object_name for object_names in expired.values() for object_name in object_names]
+    repository.delete_files(object_names)
+    logger.info(f"Deleted {len(object_names)} expired objects of {len(expired)} prefixes")
+    return len(object_names)
@@ -1,14 +1,34 @@
-from api.analysis.services.analysis_service import AnalysisService
+from api.analysis.services.analysis_service import AnalysisService, minio_repo
+from api.analysis.services.retention import delete_expired
+from api.analysis.registers import pipelines_registry
+from api.analysis.manifest import PROCESS_IMAGE_TASK, DELETE_EXPIRED_RESULTS_TASK
 from api.celery import app
+from celery.signals import worker_init
+from django.conf import settings
 
 import logging
 logger = logging.getLogger(__name__)
 
-@app.task(bind=True)
-def process_image(self, input_images, input_images_paths, input_masks, predictions_path, overlayed_path, area_per_pixel, generate_labelled_images, labelled_images_path, model, model_object_name, model_file_extension, pipeline_type, target_dimensions, downsampling_factor, threshold):
+@worker_init.connect
+def warm_up_pipelines(**kwargs):
+    # Loads the hot models before the first task instead of during it
+    pipelines_registry.warm_up(settings.WARMUP_PIPELINES)
+
+@app.task(bind=True, name=PROCESS_IMAGE_TASK)
+def process_image(self, input_images, input_images_paths, input_masks, predictions_path, overlayed_path, area_per_pixel, generate_labelled_images, labelled_images_path, model, model_object_name, model_file_extension, pipeline_type, target_dimensions, downsampling_factor, threshold, custom_model_id=None):
     try:
         logger.info(f"Starting process_image task with id: {self.request.id}")
-        return AnalysisService.process(self.request.id, input_images, input_images_paths, input_masks, predictions_path, overlayed_path, area_per_pixel, generate_labelled_images, labelled_images_path, model, model_object_name, model_file_extension, pipeline_type, target_dimensions, downsampling_factor, threshold)
+        return AnalysisService.process(self.request.id, input_images, input_images_paths, input_masks, predictions_path, overlayed_path, area_per_pixel, generate_labelled_images, labelled_images_path, model, model_object_name, model_file_extension, pipeline_type, target_dimensions, downsampling_factor, threshold, custom_model_id)
     except Exception as e:
         logger.error(f"Error in process_image task: {str(e)}")
-        return (None, None), str(e)
\ No newline at end of file
+        return (None, None, None), str(e)
+    finally:
+        try:
+            AnalysisService.delete_inputs(input_images, input_masks)
+        except Exception as e:
+            logger.error(f"Error while deleting inputs of task {self.request.id}: {str(e)}")
+
+@app.task(name=DELETE_EXPIRED_RESULTS_TASK, ignore_result=True)
+def delete_expired_results():
+    # Results are kept for RESULT_TTL_SECONDS so that task status polls can be repeated, then removed by prefix
+    return delete_expired(minio_repo, settings.RESULT_TTL_SECONDS)
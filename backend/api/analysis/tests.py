@@ -1,3 +1,302 @@
-from django.test import TestCase
+from django.test import SimpleTestCase
+from django.conf import settings
+from django.core import signing
+from django.core.files.uploadedfile import SimpleUploadedFile
+from rest_framework.test import APIRequestFactory, force_authenticate
+from botocore.stub import Stubber
+from unittest import mock
+from urllib.parse import urlsplit, parse_qs
+from api.analysis.repositories.minio_repository import MinioRepository
+from api.analysis.views import AnalysisView, TaskStatusView
+from api.analysis.services.prefetched_objects import PrefetchedObjects
+from api.analysis.services.result_uploader import ResultUploader
+from api.analysis.lazy_registry import LazyModelRegistry, LazyPipelineRegistry
+from api.analysis.processing.postprocessing import TileCanvas, find_label_meetings
+from api.analysis.processing.decoders import OpenCVImageDecoder
+from api.analysis.processing.tracing import counting_decodes
+from api.analysis.model_wrappers.abstract_model_wrapper import AbstractModelWrapper
+from api.analysis.pipelines.tiling_pipeline import TilingPipeline
+from api.analysis.pipelines.resize_with_pad_pipeline import ResizeWithPadPipeline
+from api.analysis.pipelines.dynamic_resize_with_pad_pipeline import DynamicResizeWithPadPipeline
+from api.analysis.pipelines.variable_shape_pipeline import VariableShapePipeline
+import tensorflow as tf
+import numpy as np
+import subprocess
+import tempfile
+import weakref
+import sys
+import gc
+import os
 
 # Create your tests here.
+
+class WebProcessStartupTest(SimpleTestCase):
+    IMPORT_URLS = (
+        "import time, sys, django\n"
+        "start = time.perf_counter()\n"
+        "django.setup()\n"
+        "import api.urls\n"
+        "print(f'{time.perf_counter() - start:.3f}', 'tensorflow' in sys.modules)\n"
+    )
+    # Generous bound for a cold interpreter, importing TensorFlow alone takes longer on the worker images
+    MAX_STARTUP_SECONDS = 10
+
+    def test_urls_do_not_import_tensorflow(self):
+        # Imported in a fresh interpreter, the test runner itself may have loaded TensorFlow already
+        environment = {**os.environ, 'DJANGO_SETTINGS_MODULE': 'api.settings'}
+        result = subprocess.run([sys.executable, '-c', self.IMPORT_URLS], env=environment, capture_output=True, text=True, timeout=60)
+        self.assertEqual(result.returncode, 0, result.stderr)
+        startup_time, tensorflow_loaded = result.stdout.split()[-2:]
+        self.assertEqual(tensorflow_loaded, 'False')
+        self.assertLess(float(startup_time), self.MAX_STARTUP_SECONDS)
+
+class FakeBackend:
+    def __init__(self, model_path):
+        self.model_path = model_path
+
+    def load_model(self):
+        return self
+
+class FakeModel:
+    def __init__(self, model):
+        self.model = model
+
+class FakePipeline:
+    def __init__(self, model):
+        self.model = model
+
+class LazyRegistryEvictionTest(SimpleTestCase):
+    def test_evicted_backend_is_not_kept_alive_by_pipelines(self):
+        with tempfile.NamedTemporaryFile() as model_file:
+            model_file.write(b'0' * 100)
+            model_file.flush()
+            # Room for a single backend, loading the second one evicts the first
+            models = LazyModelRegistry(
+                {'a': lambda: FakeBackend(model_file.name), 'b': lambda: FakeBackend(model_file.name)},
+                {'model-a': ('a', FakeModel), 'model-b': ('b', FakeModel)},
+                memory_budget=150,
+            )
+            pipelines = LazyPipelineRegistry(models, {'pipeline-a': ('model-a', FakePipeline), 'pipeline-b': ('model-b', FakePipeline)})
+
+            backend = weakref.ref(pipelines['pipeline-a'].model.model)
+            pipelines['pipeline-b']
+            gc.collect()
+
+            self.assertIsNone(backend())
+            self.assertEqual(list(pipelines.created_pipelines), ['pipeline-b'])
+
+            pipelines['pipeline-a']
+            self.assertEqual(list(models.loaded_backends), ['a'])
+
+class FindLabelMeetingsTest(SimpleTestCase):
+    def assert_matches_legacy(self, labelled_image, num_labels):
+        counts, points = find_label_meetings(labelled_image, num_labels)
+        legacy_counts, legacy_points = find_label_meetings(labelled_image, num_labels, legacy=True)
+        np.testing.assert_array_equal(counts, legacy_counts)
+        self.assertEqual(points, legacy_points)
+
+    def test_matches_legacy_on_random_label_images(self):
+        rng = np.random.default_rng(0)
+        for rows, cols in [(1, 1), (1, 5), (2, 2), (2, 7), (5, 1), (3, 3), (4, 9), (17, 13), (64, 48)]:
+            for num_labels in (1, 3, 12):
+                # About a third of the pixels are boundaries, the rest carry labels 1..num_labels
+                labelled_image = rng.integers(1, num_labels + 1, size=(rows, cols), dtype=np.int32)
+                labelled_image[rng.random((rows, cols)) < 0.35] = 0
+                with self.subTest(shape=(rows, cols), num_labels=num_labels):
+                    self.assert_matches_legacy(labelled_image, num_labels)
+
+    def test_matches_legacy_without_boundaries(self):
+        self.assert_matches_legacy(np.ones((6, 6), dtype=np.int32), 1)
+        self.assert_matches_legacy(np.zeros((6, 6), dtype=np.int32), 0)
+
+class StubModelWrapper(AbstractModelWrapper):
+    def __init__(self, model_path=None):
+        pass
+
+    def load_model(self):
+        return self
+
+    def predict(self, input_data):
+        # Empty masks of the input size, datasets are predicted batch by batch
+        if isinstance(input_data, tf.data.Dataset):
+            return np.concatenate([self.predict(batch) for batch in input_data])
+        return np.zeros(tuple(input_data.shape[:3]) + (1,), dtype=np.uint8)
+
+class PipelineDecodeCountTest(SimpleTestCase):
+    SHAPES = [(300, 200), (64, 96), (130, 130)]
+
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.inputs = [tf.io.encode_png(rng.integers(0, 256, size=shape + (3,), dtype=np.uint8)).numpy() for shape in self.SHAPES]
+
+    def pipelines(self):
+        model = StubModelWrapper()
+        return {
+            'resize_with_pad': ResizeWithPadPipeline(model, target_dimensions=(64, 64)),
+            'resize_with_pad full decode': ResizeWithPadPipeline(model, target_dimensions=(64, 64), reduced_decode=False),
+            'dynamic_resize_with_pad': DynamicResizeWithPadPipeline(model, downsampling_factor=32),
+            'variable_shape': VariableShapePipeline(model, downsampling_factor=32),
+            'tiling': TilingPipeline(model, patch_size=(64, 64, 3)),
+            'tiling opencv': TilingPipeline(model, patch_size=(64, 64, 3), image_decoder=OpenCVImageDecoder(max_workers=2)),
+        }
+
+    def test_process_decodes_every_input_once(self):
+        for name, pipeline in self.pipelines().items():
+            with self.subTest(pipeline=name), counting_decodes() as decodes:
+                predictions, images = pipeline.process(self.inputs)
+                self.assertEqual(len(predictions), len(self.inputs))
+                self.assertEqual(images.shapes, self.SHAPES)
+                self.assertEqual(decodes['images'], len(self.inputs))
+
+    def test_only_jpegs_are_decoded_at_reduced_resolution(self):
+        jpeg = tf.io.encode_jpeg(np.zeros((300, 200, 3), dtype=np.uint8)).numpy()
+        pipeline = ResizeWithPadPipeline(StubModelWrapper(), target_dimensions=(64, 64))
+        with counting_decodes() as decodes:
+            _, images = pipeline.process(self.inputs + [jpeg])
+            originals = list(images.originals())
+        self.assertEqual(images.reduction_factors, [1, 1, 1, 4])
+        self.assertEqual([original.shape[:2] for original in originals], self.SHAPES + [(300, 200)])
+        # Only the reduced JPEG is decoded a second time, at full resolution
+        self.assertEqual(decodes['images'], len(self.inputs) + 2)
+
+    def test_streamed_originals_are_not_decoded_again(self):
+        # Same order as the analysis service, the original of an image is read before its prediction
+        pipeline = TilingPipeline(StubModelWrapper(), patch_size=(64, 64, 3))
+        with counting_decodes() as decodes:
+            predictions, images = pipeline.process_stream(self.inputs)
+            for original, prediction in zip(images.originals(), predictions):
+                self.assertEqual(original.shape[:2], prediction.shape[:2])
+        self.assertEqual(decodes['images'], len(self.inputs))
+
+class PresignedDeliveryTest(SimpleTestCase):
+    BUCKET = 'test-bucket'
+
+    def setUp(self):
+        with mock.patch.object(MinioRepository, '_create_bucket_if_not_exists'):
+            self.repository = MinioRepository('http://minio:9000', 'minio', 'minio123', self.BUCKET, public_endpoint_url=settings.MINIO_PUBLIC_ENDPOINT_URL)
+        self.stubber = Stubber(self.repository.s3_client)
+        self.stubber.activate()
+        self.addCleanup(self.stubber.deactivate)
+
+    def get_status(self, object_names=None):
+        if object_names is not None:
+            self.stubber.add_response('list_objects_v2', {'Contents': [{'Key': name} for name in object_names], 'IsTruncated': False}, {'Bucket': self.BUCKET, 'Prefix': 'task-1\\'})
+        task = mock.Mock(state='SUCCESS', result=((None, [], {}), None))
+        request = APIRequestFactory().get('/task-status/signed/', {'delivery': 'presigned'})
+        force_authenticate(request, user=mock.Mock(id=1, is_authenticated=True))
+        with mock.patch('api.analysis.views.get_minio_repo', return_value=self.repository), mock.patch('api.analysis.views.app.AsyncResult', return_value=task):
+            response = TaskStatusView.as_view()(request, task_id=signing.dumps('task-1:1'))
+        self.stubber.assert_no_pending_responses()
+        return response
+
+    def test_manifest_lists_signed_urls_in_result_order(self):
+        response = self.get_status(['task-1\\001\\overlayed/image.png', 'task-1\\000\\predictions/image.png'])
+
+        self.assertEqual(response.status_code, 200)
+        data = response.data['data']
+        self.assertEqual(data['state'], 'success')
+        self.assertEqual(data['expires_in'], settings.PRESIGNED_URL_EXPIRATION)
+        self.assertEqual([result['filename'] for result in data['results']], ['predictions/image.png', 'overlayed/image.png'])
+
+        public_endpoint = urlsplit(settings.MINIO_PUBLIC_ENDPOINT_URL)
+        for result, key in zip(data['results'], ['task-1%5C000%5Cpredictions/image.png', 'task-1%5C001%5Coverlayed/image.png']):
+            url = urlsplit(result['url'])
+            query = parse_qs(url.query)
+            self.assertEqual((url.scheme, url.netloc), (public_endpoint.scheme, public_endpoint.netloc))
+            self.assertEqual(url.path, f'/{self.BUCKET}/{key}')
+            self.assertEqual(query['response-content-disposition'], ['attachment; filename="image.png"'])
+            self.assertEqual(query['X-Amz-Expires'], [str(settings.PRESIGNED_URL_EXPIRATION)])
+            self.assertIn('X-Amz-Signature', query)
+
+    def test_expired_results_are_gone(self):
+        response = self.get_status([])
+
+        self.assertEqual(response.status_code, 410)
+        self.assertEqual(response.data['data'], {'state': 'expired'})
+
+    def test_listing_errors_are_not_reported_as_expired(self):
+        self.stubber.add_client_error('list_objects_v2', service_error_code='AccessDenied', http_status_code=403)
+        response = self.get_status()
+
+        self.assertEqual(response.status_code, 500)
+        self.assertEqual(response.data['status'], 'error')
+
+class FakeRepository:
+    def __init__(self):
+        self.downloads = []
+
+    def download_bytes(self, object_name):
+        self.downloads.append(object_name)
+        return object_name.encode('utf-8')
+
+class PrefetchedObjectsTest(SimpleTestCase):
+    def test_reads_in_order_and_fetches_only_ahead(self):
+        repository = FakeRepository()
+        with PrefetchedObjects(repository, ['a', None, 'c', 'd', 'e'], prefetch=1) as objects:
+            self.assertEqual(objects[0], b'a')
+            # Only the next object is prefetched, a missing name is never downloaded
+            self.assertEqual(sorted(repository.downloads), ['a'])
+            self.assertEqual(list(objects), [b'a', None, b'c', b'd', b'e'])
+
+class TileCanvasTest(SimpleTestCase):
+    def test_overlapping_probabilities_are_thresholded_after_blending(self):
+        # Two tiles overlap in columns 2 and 3, one of them below and one above the threshold
+        canvas = TileCanvas(4, 6, 4, 4, blend=True, threshold=0.5)
+        canvas.add(np.full((4, 4, 1), 0.45, dtype=np.float32), 0, 0)
+        canvas.add(np.full((4, 4, 1), 0.9, dtype=np.float32), 0, 2)
+        mask = canvas.crop(4, 6)[..., 0]
+
+        self.assertEqual(mask.dtype, np.uint8)
+        np.testing.assert_array_equal(mask[:, :2], 0)
+        np.testing.assert_array_equal(mask[:, 2:], 255)
+
+    def test_without_blending_tiles_are_copied(self):
+        canvas = TileCanvas(4, 8, 4, 4)
+        canvas.add(np.zeros((4, 4, 1), dtype=np.uint8), 0, 0)
+        canvas.add(np.full((4, 4, 1), 255, dtype=np.uint8), 0, 4)
+        np.testing.assert_array_equal(canvas.crop(3, 6)[..., 0], [[0] * 4 + [255] * 2] * 3)
+
+class RegisteredCustomModelAnalysisTest(SimpleTestCase):
+    CUSTOM_MODEL_ID = '0' * 64 + '.keras'
+
+    def test_analysis_with_registered_custom_model_is_enqueued(self):
+        request = APIRequestFactory().post('/analysis/', {
+            'input_images': [SimpleUploadedFile('image.png', b'image')],
+            'masks': ['none'],
+            'input_paths': ['image.png'],
+            'generate_labelled_images': 'false',
+            'predictions_output_path': 'predictions',
+            'overlayed_output_path': 'overlayed',
+            'area_per_pixel': '1.0',
+            'custom_model_id': self.CUSTOM_MODEL_ID,
+            'custom_model_pipeline': 'Tiling',
+            'threshold': '0.5',
+            'target_height': '128',
+            'target_width': '128',
+            'downsampling_factor': '64',
+        }, format='multipart')
+        force_authenticate(request, user=mock.Mock(id=1, is_authenticated=True))
+        repository = mock.Mock()
+        repository.file_exists.return_value = True
+        repository.upload_files_directly.side_effect = lambda files, names: list(names)
+        with mock.patch('api.analysis.views.get_minio_repo', return_value=repository), mock.patch('api.analysis.views.app.send_task', return_value=mock.Mock(id='task-1')) as send_task:
+            response = AnalysisView.as_view()(request)
+
+        self.assertEqual(response.status_code, 202)
+        args, kwargs = send_task.call_args
+        self.assertEqual(kwargs['kwargs'], {'custom_model_id': self.CUSTOM_MODEL_ID})
+        self.assertEqual(kwargs['args'][9], f'custom-models/{self.CUSTOM_MODEL_ID}')
+        repository.file_exists.assert_called_once_with(f'custom-models/{self.CUSTOM_MODEL_ID}')
+        repository.upload_file_directly.assert_not_called()
+
+class ResultUploaderTest(SimpleTestCase):
+    def test_gives_up_without_sleeping_after_the_last_attempt(self):
+        repository = mock.Mock()
+        repository.upload_file_directly.return_value = None
+        uploader = ResultUploader(repository, max_retries=3, retry_delay=0.5)
+        with mock.patch('api.analysis.services.result_uploader.time.sleep') as sleep:
+            with self.assertRaises(IOError):
+                uploader.upload(b'data', 'task\\000\\image.png')
+
+        self.assertEqual(repository.upload_file_directly.call_count, 3)
+        self.assertEqual([call.args[0] for call in sleep.call_args_list], [0.5, 1.0])
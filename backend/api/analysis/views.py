@@ -4,9 +4,11 @@ import logging
 import zipfile
 from rest_framework.response import Response
 from rest_framework import status
-from api.analysis.tasks import process_image
-from django.http import JsonResponse
-from api.analysis.registers import pipelines_registry
+from django.http import JsonResponse, StreamingHttpResponse
+from api.utils.zip_utils import stream_zip
+from api.analysis.manifest import pipeline_manifest, PROCESS_IMAGE_TASK, CUSTOM_MODELS_PREFIX, INPUTS_PREFIX
+import functools
+import hashlib
 import zipfile
 import os
 import tempfile
@@ -14,14 +16,24 @@ import uuid
 from api.analysis.repositories.minio_repository import MinioRepository
 import base64
 from django.core import signing
+from django.conf import settings
+from django.urls import reverse
+from django.utils.http import parse_etags, quote_etag
 from api.celery import app
 from rest_framework.permissions import AllowAny
-from api.analysis.serializers import AnalysisRequestSerializer
+from api.analysis.serializers import AnalysisRequestSerializer, CustomModelSerializer
 
 def generate_object_name():
     unique_id = uuid.uuid4()
     return f"{unique_id}"
 
+def content_hash(uploaded_file):
+    digest = hashlib.sha256()
+    for chunk in uploaded_file.chunks():
+        digest.update(chunk)
+    uploaded_file.seek(0)
+    return digest.hexdigest()
+
 def jsend_success(data, status=status.HTTP_200_OK):
     return Response({
         "status": "success",
@@ -40,12 +52,16 @@ def jsend_error(message = "Internal server error", status=status.HTTP_500_INTERN
         "message": message
     }, status=status)
 
-minio_repo = MinioRepository(
-    endpoint_url='http://minio:9000',
-    access_key='minio',
-    secret_key='minio123',
-    bucket_name='corneal-endothelium-analeyezer'
-)
+@functools.lru_cache(maxsize=None)
+def get_minio_repo():
+    # Created on first use, importing the URL configuration must not need a reachable object store
+    return MinioRepository(
+        endpoint_url='http://minio:9000',
+        access_key='minio',
+        secret_key='minio123',
+        bucket_name='corneal-endothelium-analeyezer',
+        public_endpoint_url=settings.MINIO_PUBLIC_ENDPOINT_URL
+    )
 
 logger = logging.getLogger(__name__)
 
@@ -79,6 +95,7 @@ class AnalysisView(APIView):
         """
         labelled_output_path = serializer.validated_data['labelled_output_path'] if generate_labelled_images else None
  
+        custom_model_id = None
         if 'pipeline' in serializer.validated_data:
             pipeline = serializer.validated_data['pipeline']
             custom_model_object_name = None
@@ -90,33 +107,47 @@ class AnalysisView(APIView):
             downsampling_factor = None
         else:
             pipeline = None
-            custom_model = serializer.validated_data['custom_model']
             custom_model_pipeline = serializer.validated_data['custom_model_pipeline']
             threshold = serializer.validated_data['threshold']
             target_height = serializer.validated_data['target_height']
             target_width = serializer.validated_data['target_width']
             downsampling_factor = serializer.validated_data['downsampling_factor']
 
-            logger.debug(f"custom_model: {custom_model}")
-            
-            logger.debug(f"custom_model name is: {custom_model.name}")
-            custom_model_name, custom_model_extension = os.path.splitext(custom_model.name)
-            
-            logger.debug(f"custom_model_name: {custom_model_name}")
-            logger.debug(f"custom_model_extension: {custom_model_extension}")
-            
-            custom_model_object_name = generate_object_name()
-            minio_repo.upload_file_directly(custom_model, custom_model_object_name)
+            if 'custom_model_id' in serializer.validated_data:
+                # Registered models stay in the repository and are not uploaded again
+                custom_model_id = serializer.validated_data['custom_model_id']
+                custom_model_object_name = f"{CUSTOM_MODELS_PREFIX}{custom_model_id}"
+                custom_model_extension = os.path.splitext(custom_model_id)[1]
+                if not get_minio_repo().file_exists(custom_model_object_name):
+                    return jsend_fail({"custom_model_id": "Unknown custom model"})
+            else:
+                custom_model = serializer.validated_data['custom_model']
+                logger.debug(f"custom_model: {custom_model}")
+                
+                logger.debug(f"custom_model name is: {custom_model.name}")
+                custom_model_name, custom_model_extension = os.path.splitext(custom_model.name)
+                
+                logger.debug(f"custom_model_name: {custom_model_name}")
+                logger.debug(f"custom_model_extension: {custom_model_extension}")
+                
+                custom_model_object_name = generate_object_name()
+                get_minio_repo().upload_file_directly(custom_model, custom_model_object_name)
         
-        file_bytes_list = [file.read() for file in input_images]
+        # Inputs are streamed to the repository, the task message only carries their object names
+        input_prefix = f"{INPUTS_PREFIX}{generate_object_name()}/"
+        input_image_keys = [f"{input_prefix}{index:04d}" for index in range(len(input_images))]
+        input_mask_keys = [f"{input_prefix}{index:04d}-mask" if mask else None for index, mask in enumerate(masks)]
+        uploads = [(file, key) for file, key in zip(input_images, input_image_keys)] + [(mask, key) for mask, key in zip(masks, input_mask_keys) if key]
         
-        # Convert masks to bytes if they are not None
-        mask_bytes_list = [mask.read() if mask else None for mask in masks]
+        logger.debug(f"uploading {len(uploads)} inputs to {input_prefix}")
+        upload_results = get_minio_repo().upload_files_directly([file for file, _ in uploads], [key for _, key in uploads])
+        if any(result is None for result in upload_results):
+            logger.error(f"Error while uploading inputs to {input_prefix}")
+            get_minio_repo().delete_files([key for _, key in uploads])
+            return jsend_error()
         
-        #logger.debug(f"file_paths: {file_paths}")
-        #logger.debug(f"mask_bytes_list: {mask_bytes_list}")
-        logger.debug(f"len(file_bytes_list): {len(file_bytes_list)}")
-        logger.debug(f"len(mask_bytes_list): {len(mask_bytes_list)}")
+        logger.debug(f"len(input_image_keys): {len(input_image_keys)}")
+        logger.debug(f"len(input_mask_keys): {len(input_mask_keys)}")
         logger.debug(f"input_paths: {input_paths}")
         logger.debug(f"predictions_output_path: {predictions_output_path}")
         logger.debug(f"overlayed_output_path: {overlayed_output_path}")
@@ -134,9 +165,12 @@ class AnalysisView(APIView):
         
         logger.debug(f'Creating task to process {len(input_images)} images')
         try:
-            task = process_image.delay(file_bytes_list, input_paths, mask_bytes_list, predictions_output_path, overlayed_output_path, area_per_pixel, generate_labelled_images, labelled_output_path, pipeline, custom_model_object_name, custom_model_extension, custom_model_pipeline, (target_height, target_width), downsampling_factor, threshold)
+            # Enqueued by name, importing the task would load TensorFlow and the models into the web process
+            task = app.send_task(PROCESS_IMAGE_TASK, args=[input_image_keys, input_paths, input_mask_keys, predictions_output_path, overlayed_output_path, area_per_pixel, generate_labelled_images, labelled_output_path, pipeline, custom_model_object_name, custom_model_extension, custom_model_pipeline, (target_height, target_width), downsampling_factor, threshold], kwargs={'custom_model_id': custom_model_id})
         except Exception as e:
             logger.error(f'Error while starting task: {str(e)}')
+            # No worker will pick up the inputs, so they are deleted here, registered custom models are kept
+            get_minio_repo().delete_files([key for _, key in uploads] + ([custom_model_object_name] if custom_model_object_name and not custom_model_id else []))
             return Response(str(e), status=status.HTTP_400_BAD_REQUEST)
         
         user_id = request.user.id
@@ -159,36 +193,169 @@ class AnalysisView(APIView):
         return jsend_success(response_data, status=status.HTTP_202_ACCEPTED)
         
     
+class CustomModelView(APIView):
+    parser_classes = (MultiPartParser,)
+    def post(self, request, *args, **kwargs):
+        serializer = CustomModelSerializer(data=request.data)
+        if not serializer.is_valid():
+            logger.debug(f"validation error: {serializer.errors}")
+            return jsend_fail(serializer.errors)
+
+        custom_model = serializer.validated_data['custom_model']
+        custom_model_id = f"{content_hash(custom_model)}{os.path.splitext(custom_model.name)[1].lower()}"
+        object_name = f"{CUSTOM_MODELS_PREFIX}{custom_model_id}"
+
+        # The same content always maps to the same id, so a model registered before is not uploaded again
+        if get_minio_repo().file_exists(object_name):
+            logger.debug(f"custom model {custom_model_id} is already registered")
+            return jsend_success({"custom_model_id": custom_model_id})
+
+        if get_minio_repo().upload_file_directly(custom_model, object_name) is None:
+            return jsend_error()
+        logger.debug(f"registered custom model {custom_model_id}")
+        return jsend_success({"custom_model_id": custom_model_id}, status=status.HTTP_201_CREATED)
+
 class ModelsView(APIView):
     permission_classes = [AllowAny]
     def get(self, request, format=None):
-        model_names = list(pipelines_registry.keys())
+        model_names = list(pipeline_manifest.keys())
         logger.debug(f"model names: {model_names}")
+        if request.query_params.get('details'):
+            return Response(pipeline_manifest)
         return Response(model_names)
     
-class TaskStatusView(APIView):
+def verify_task_id(request, signed_task_id):
+    # Returns the task id if the signed id is valid and belongs to the user of the request, None otherwise
+    try:
+        # Attempt to load the original values from the signed ID
+        original_value = signing.loads(signed_task_id)
+        task_id, original_user_id = original_value.split(':')
+    except signing.BadSignature:
+        logger.warning(f"bad signature")
+        return None
+    
+    logger.debug(f"task_id: {task_id}")
+    logger.debug(f"original_user_id: {original_user_id}")
+    
+    try:
+        original_user_id = int(original_user_id)
+    except ValueError:
+         logger.warning("original_user_id is not an integer")
+         return None
+     
+    if request.user.id != original_user_id:
+        logger.warning(f"user id does not match original user id")
+        return None
+    return task_id
+
+def format_metrics(metrics):
+    return [
+    {
+        'num_labels': num_labels,
+        'area': area,
+        'cell_density': cell_density,
+        'std_areas': std_areas,
+        'mean_areas': mean_areas,
+        'coefficient_value': coefficient_value,
+        'num_hexagonal': num_hexagonal,
+        'hexagonal_cell_ratio': hexagonal_cell_ratio,
+    }
+    
+    for num_labels, area, cell_density, std_areas, mean_areas, coefficient_value, num_hexagonal, hexagonal_cell_ratio in metrics]
+
+def archive_name(object_name):
+    # Objects are stored as task_id\index\output path, the archive keeps the output path layout
+    return object_name.split('\\')[-1].lstrip('/')
+
+# botocore reads 1 KiB chunks by default, which would make a zip write and a response chunk per KiB
+RESULT_CHUNK_SIZE = 64 * 1024
+
+def task_result_entries(object_names):
+    minio_repo = get_minio_repo()
+    for object_name in object_names:
+        response = minio_repo.s3_client.get_object(Bucket=minio_repo.bucket_name, Key=object_name)
+        yield archive_name(object_name), response['ContentLength'], response['Body'].iter_chunks(chunk_size=RESULT_CHUNK_SIZE)
+
+def presigned_results(object_names):
+    return [
+    {
+        'filename': archive_name(object_name),
+        'url': get_minio_repo().presigned_url(object_name, settings.PRESIGNED_URL_EXPIRATION, download_name=os.path.basename(archive_name(object_name))),
+    }
+    
+    for object_name in sorted(object_names)]
+
+def results_etag(task_id, task_objects, delivery):
+    # Results of a task never change while they are kept, the object ETags guard against a task id being reused
+    digest = hashlib.sha256(f"{task_id}:{delivery}".encode('utf-8'))
+    for item in task_objects:
+        digest.update(f"{item['Key']}:{item['ETag']}".encode('utf-8'))
+    return quote_etag(digest.hexdigest())
+
+def not_modified(request, etag):
+    if_none_match = parse_etags(request.META.get('HTTP_IF_NONE_MATCH', ''))
+    return etag in if_none_match or '*' in if_none_match
+
+def with_etag(response, etag):
+    response['ETag'] = etag
+    # Clients keep the response but revalidate it on every poll
+    response['Cache-Control'] = 'private, no-cache'
+    return response
+
+def results_expired():
+    # A successful task always stores results, none left means the retention janitor deleted them
+    return jsend_fail({"state": "expired"}, status=status.HTTP_410_GONE)
+
+class TaskResultsView(APIView):
     def get(self, request, task_id):
-        try:
-            # Attempt to load the original values from the signed ID
-            original_value = signing.loads(task_id)
-            task_id, original_user_id = original_value.split(':')
-        except signing.BadSignature:
-            logger.warning(f"bad signature")
+        task_id = verify_task_id(request, task_id)
+        if task_id is None:
             return jsend_fail("bad signature")
-        
-        logger.debug(f"task_id: {task_id}")
-        logger.debug(f"type of task_id: {type(task_id)}")
-        logger.debug(f"original_user_id: {original_user_id}")
-        logger.debug(f"type of original_user_id: {type(original_user_id)}")
-        
-        try:
-            original_user_id = int(original_user_id)
-        except ValueError:
-             logger.warning("original_user_id is not an integer")
-             return jsend_fail("bad signature")
-         
-        if request.user.id != original_user_id:
-            logger.warning(f"user id does not match original user id")
+
+        task_status = app.AsyncResult(task_id)
+        if task_status.state != 'SUCCESS':
+            return jsend_fail({"state": task_status.state.lower()}, status=status.HTTP_404_NOT_FOUND)
+
+        # Failed analyses finish as successful tasks carrying an error, their results may be missing or partial
+        _, error = task_status.result
+        if error:
+            logger.debug(f"recieved error from task_status.result: {error}")
+            return jsend_error()
+
+        task_objects = sorted(get_minio_repo().iterate_files(prefix=f"{task_id}\\"), key=lambda item: item['Key'])
+        if not task_objects:
+            return results_expired()
+
+        etag = results_etag(task_id, task_objects, 'zip')
+        if not_modified(request, etag):
+            return with_etag(Response(status=status.HTTP_304_NOT_MODIFIED), etag)
+
+        # Object reads go straight into the archive, the results are kept until they expire so the download can be repeated
+        response = StreamingHttpResponse(stream_zip(task_result_entries([item['Key'] for item in task_objects])), content_type='application/zip')
+        response['Content-Disposition'] = f'attachment; filename="results.zip"'
+        return with_etag(response, etag)
+
+class TaskMetricsView(APIView):
+    def get(self, request, task_id):
+        task_id = verify_task_id(request, task_id)
+        if task_id is None:
+            return jsend_fail("bad signature")
+
+        task_status = app.AsyncResult(task_id)
+        if task_status.state != 'SUCCESS':
+            return jsend_success({"state": task_status.state.lower()})
+
+        (_, metrics, stats), error = task_status.result
+        if error:
+            logger.debug(f"recieved error from task_status.result: {error}")
+            return jsend_error()
+        return jsend_success({"state": "success", "metrics": format_metrics(metrics), "stats": stats})
+
+class TaskStatusView(APIView):
+    def get(self, request, task_id):
+        signed_task_id = task_id
+        task_id = verify_task_id(request, signed_task_id)
+        if task_id is None:
             return jsend_fail("bad signature")
         
         task_status = app.AsyncResult(task_id)
@@ -196,35 +363,60 @@ class TaskStatusView(APIView):
         state = task_status.state
         logger.debug(f"task state: {state}")
         
-        result = task_status.result
-        if result:
-            #might be [None, None], [None, error], [[data, filename], None], [[data, filename], None]
-            logger.debug(f"task result exist")
-        else:
-            # is None
-            logger.debug(f"task result does not exist")
-            logger.debug(f"task result {result}")
+        # Unfinished tasks are answered from the task state alone, without reading the result or the repository
+        if state == 'PENDING':
+            logger.debug(f"task state is pending")
+            return jsend_success({"state": "pending"})
+        elif state == 'STARTED':
+            logger.debug(f"task state is started")
+            return jsend_success({"state": "started"})
             
         if state == 'SUCCESS':
-            (processed_data, metrics), error = result
+            result = task_status.result
+            #might be [None, None], [None, error], [[data, filename], None], [[data, filename], None]
+            logger.debug(f"task result {'exists' if result else 'does not exist'}")
+            (processed_data, metrics, stats), error = result
+            if error == None and request.query_params.get('delivery') == 'presigned':
+                # Clients download the results from the object store in parallel, only this manifest goes through Django
+                try:
+                    # Listing errors must not read as expired results, so they are not swallowed by list_files
+                    object_names = [item['Key'] for item in get_minio_repo().iterate_files(prefix=f"{task_id}\\")]
+                    results = presigned_results(object_names)
+                except Exception as e:
+                    logger.error(f"Error while signing result urls: {str(e)}")
+                    return jsend_error()
+                if not object_names:
+                    return results_expired()
+                return jsend_success({"state": "success", "results": results, "expires_in": settings.PRESIGNED_URL_EXPIRATION, "metrics": format_metrics(metrics), "stats": stats})
+            if error == None and request.query_params.get('delivery') == 'zip':
+                # Results are left in the repository for the streaming download
+                return jsend_success({
+                    "state": "success",
+                    "results_url": request.build_absolute_uri(reverse('task-results', args=[signed_task_id])),
+                    "metrics_url": request.build_absolute_uri(reverse('task-metrics', args=[signed_task_id])),
+                })
             if processed_data == None and error == None:
                 try:
-                    files = minio_repo.list_files()
-                    task_files = [f for f in files if f.startswith(f"{task_id}\\")]
+                    task_objects = sorted(get_minio_repo().iterate_files(prefix=f"{task_id}\\"), key=lambda item: item['Key']) # Sorting to maintain order
+                    task_files = [item['Key'] for item in task_objects]
                     logger.debug(f"found {len(task_files)} task_files")
                     logger.debug(f"task_files: {task_files}")
                 except Exception as e:
                     logger.error(f"Error while fetching files from repository: {str(e)}")
                     return jsend_error()
+                if not task_files:
+                    return results_expired()
                 
-                try:
-                    task_files.sort()  # Sorting to maintain order
+                # Results are kept until they expire, a repeated poll of unchanged results is answered without downloading them
+                etag = results_etag(task_id, task_objects, 'inline')
+                if not_modified(request, etag):
+                    return with_etag(Response(status=status.HTTP_304_NOT_MODIFIED), etag)
                 
+                try:
                     results = []
                     for file_name in task_files:
                         logger.debug(f"Downloading {file_name}...")
-                        response = minio_repo.s3_client.get_object(Bucket=minio_repo.bucket_name, Key=file_name)
-                        file_content = response['Body'].read()
+                        file_content = get_minio_repo().download_bytes(file_name)
                         encoded_data = base64.b64encode(file_content).decode('utf-8')
                         results.append({
                             'filename': file_name.split('\\')[-1],  # Just the filename
@@ -237,13 +429,8 @@ class TaskStatusView(APIView):
                 except Exception as e:
                     logger.error(f"Error while downloading files from repository: {str(e)}")
                     return jsend_error()
-                finally:
-                    try:
-                        logger.debug(f"deleting files from minio")
-                        minio_repo.delete_files(task_files)
-                    except Exception as e:
-                        logger.error(f"Error while deleting files from repository: {str(e)}")
-                        return jsend_error()
+                
+                return with_etag(jsend_success({"state": "success", "results": results, "metrics": format_metrics(metrics), "stats": stats}), etag)
             else:
                 try:
                     logger.debug(f"getting result from task_status.result")
@@ -271,32 +458,14 @@ class TaskStatusView(APIView):
                     logger.error(f"Error while getting result from task_status.result: {str(e)}")
                     return jsend_error()
             
-            metrics_string = [
-            {
-                'num_labels': num_labels,
-                'area': area,
-                'cell_density': cell_density,
-                'std_areas': std_areas,
-                'mean_areas': mean_areas,
-                'coefficient_value': coefficient_value,
-                'num_hexagonal': num_hexagonal,
-                'hexagonal_cell_ratio': hexagonal_cell_ratio,
-            }
-            
-            for num_labels, area, cell_density, std_areas, mean_areas, coefficient_value, num_hexagonal, hexagonal_cell_ratio in metrics]
-            return jsend_success({"state": "success", "results": results, "metrics": metrics_string})
-        elif state == 'PENDING':
-            logger.debug(f"task state is pending")
-            return jsend_success({"state": "pending"})
+            metrics_string = format_metrics(metrics)
+            return jsend_success({"state": "success", "results": results, "metrics": metrics_string, "stats": stats})
         elif state == 'FAILURE':
             logger.debug(f"task state is failure")
             return jsend_success({"state": "failure"})
         elif state == 'REVOKED':
             logger.debug(f"task state is revoked")
             return jsend_error()
-        elif state == 'STARTED':
-            logger.debug(f"task state is started")
-            return jsend_success({"state": "started"})
         elif state == 'RETRY':
             logger.debug(f"task state is retry")
             return jsend_error()
@@ -2,7 +2,7 @@ from django.urls import include, path
 from django.contrib import admin
 from rest_framework import routers
 from api.user_management.views import UserViewSet, GroupViewSet
-from api.analysis.views import AnalysisView, TaskStatusView, ModelsView
+from api.analysis.views import AnalysisView, TaskStatusView, TaskResultsView, TaskMetricsView, ModelsView, CustomModelView
 
 router = routers.DefaultRouter()
 router.register(r'users', UserViewSet)
@@ -14,5 +14,8 @@ urlpatterns = [
     path('api-auth/', include('rest_framework.urls', namespace='rest_framework')),
     path('analysis/', AnalysisView.as_view()),
     path('task-status/<str:task_id>/', TaskStatusView.as_view(), name='task-status'),
+    path('task-results/<str:task_id>/', TaskResultsView.as_view(), name='task-results'),
+    path('task-metrics/<str:task_id>/', TaskMetricsView.as_view(), name='task-metrics'),
     path('analysis/models', ModelsView.as_view()),
+    path('analysis/custom-models', CustomModelView.as_view()),
 ]
\ No newline at end of file
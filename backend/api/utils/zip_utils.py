@@ -0,0 +1,41 @@
+import io
+import zipfile
+
+class ZipStreamBuffer(io.RawIOBase):
+    """Write-only, unseekable file that hands out what was written so far, zipfile then writes data descriptors instead of seeking back."""
+    def __init__(self):
+        self.chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def pop(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+def stream_zip(entries, compression=zipfile.ZIP_STORED):
+    """
+    Yields a ZIP archive chunk by chunk without holding more than one chunk of it in memory.
+
+    Parameters:
+    entries: iterable of (archive name, size in bytes, iterable of byte chunks)
+    compression: zipfile compression method, PNGs are already compressed so they are stored by default
+    """
+    buffer = ZipStreamBuffer()
+    with zipfile.ZipFile(buffer, mode='w', compression=compression) as archive:
+        for name, size, chunks in entries:
+            info = zipfile.ZipInfo(name)
+            info.compress_type = compression
+            info.file_size = size
+            with archive.open(info, mode='w', force_zip64=size > zipfile.ZIP64_LIMIT) as file:
+                for chunk in chunks:
+                    file.write(chunk)
+                    yield buffer.pop()
+            yield buffer.pop()
+    # central directory
+    yield buffer.pop()